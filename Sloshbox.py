@@ -12,24 +12,35 @@ from __future__ import division
 # look for it and uncomment appropriate lines when deploying to RPI
 RUNNINGONRPI = True
 
+import array
 import time
 import sys
 import optparse
 import random
 import opc, color_utils
+import allocations
+import boards
+import bytefield
+import compositor
+import dither
+import framebuffer
+import layout
+import orientation
 import pytweening
 import switch_case
 import math
-
-if RUNNINGONRPI:
-    import adxl345
-    print
+import multiprocessing
+import os
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+if RUNNINGONRPI:
+    import adxl345
+    print
+
 #-------------------------------------------------------------------------------
 # Visualization Tweak Values!
 default_fps = 60
@@ -38,6 +49,13 @@ drainAmount = 0.1
 # amount to drain from each array square per tick.
 wave_spawn_period = 0.1
 g_tolerance = 4
+# magnitude of a g_tolerance sample on every axis; waves spawned at this magnitude move fastest
+MaxMagnitude = math.sqrt(3 * g_tolerance * g_tolerance)
+# number of accelerometer samples collected (evenly spaced) per wave_spawn_period
+# while the box is moving: up to 40 samples a second, which the sensor's 100 Hz
+# active rate can supply. The loop samples at most once a frame, so at 60 fps a
+# window usually holds 3 of them
+accel_window_size = 4
 
 color_white = (255,255,255)
 color_01 = (60, 43, 212) # 3C2BD4, primary wedding color
@@ -61,6 +79,18 @@ pitch_threshold = 0.0015
 # increment by which angle must change from previous amount to generate a new wave (in radians)
 waveAngleIncrement = 0.0015
 
+# when nothing is moving and the field has drained, stop rendering and only wake
+# up to sample the accelerometer
+idle_when_still = True
+
+# fadecandy firmware options, sent along with --hardware-gamma
+fc_dithering = True
+fc_interpolation = True
+
+# low-pass smoothing applied to accelerometer samples before roll/pitch are checked.
+# 1.0 = raw samples, smaller = smoother (and fewer noise-spawned waves)
+orientation_smoothing = 0.25
+
 class Wave(object):
     """
     Define a wave
@@ -91,11 +121,11 @@ class Wave(object):
         self.CheckWaveConstraints()
 
     def CheckWaveConstraints(self):
-        if self.x1 > LED_xsize and self.x2 > LED_xsize:
+        if self.x1 > SIM_xsize and self.x2 > SIM_xsize:
             self.delete_flag = True
         if self.x1 < 0 and self.x2 < 0:
             self.delete_flag = True
-        if self.y1 > LED_ysize and self.y2 > LED_ysize:
+        if self.y1 > SIM_ysize and self.y2 > SIM_ysize:
             self.delete_flag = True
         if self.y1 < 0 and self.y2 < 0:
             self.delete_flag = True
@@ -109,9 +139,9 @@ class Wave(object):
                     self.x1 = -1
                     self.y1 = -1
                     self.x2 = -1
-                    self.y2 = LED_ysize
+                    self.y2 = SIM_ysize
 
-                self.x_velocity = 1.0
+                self.x_velocity = waveStepX
                 self.y_velocity = 0.0
                 break
 
@@ -119,12 +149,12 @@ class Wave(object):
                 # wave traveling Right to Left
                 self.wave_type = toset
                 if resetcoords:
-                    self.x1 = LED_xsize
+                    self.x1 = SIM_xsize
                     self.y1 = -1
-                    self.x2 = LED_xsize
-                    self.y2 = LED_ysize
+                    self.x2 = SIM_xsize
+                    self.y2 = SIM_ysize
 
-                self.x_velocity = -1.0
+                self.x_velocity = -waveStepX
                 self.y_velocity = 0.0
                 break
 
@@ -134,11 +164,11 @@ class Wave(object):
                 if resetcoords:
                     self.x1 = -1
                     self.y1 = -1
-                    self.x2 = LED_xsize
+                    self.x2 = SIM_xsize
                     self.y2 = -1
 
                 self.x_velocity = 0.0
-                self.y_velocity = 1.0
+                self.y_velocity = waveStepY
                 break
 
             if case("BTT"):
@@ -146,12 +176,12 @@ class Wave(object):
                 self.wave_type = toset
                 if resetcoords:
                     self.x1 = -1
-                    self.y1 = LED_ysize
-                    self.x2 = LED_xsize
-                    self.y2 = LED_ysize
+                    self.y1 = SIM_ysize
+                    self.x2 = SIM_xsize
+                    self.y2 = SIM_ysize
 
                 self.x_velocity = 0.0
-                self.y_velocity = -1.0
+                self.y_velocity = -waveStepY
                 break
 
             if case():
@@ -160,9 +190,9 @@ class Wave(object):
                     self.x1 = -1
                     self.y1 = -1
                     self.x2 = -1
-                    self.y2 = LED_ysize
+                    self.y2 = SIM_ysize
 
-                self.x_velocity = 1.0
+                self.x_velocity = waveStepX
                 self.y_velocity = 0.0
                 break
 
@@ -182,47 +212,42 @@ class Wave(object):
         self.update_period = (updateSpeed_max - (pytweening.linear(speed) * (updateSpeed_max-updateSpeed_min)))
 
 # ------------
-# Make 1-2 waves depending on current axes accelerometer sample!
-def align(axes, rollWave, pitchWave):
+# smooths sensor noise out of the samples handed to align_window()
+axesFilter = orientation.AxesFilter(orientation_smoothing)
+
+# Make 1-2 waves from a whole window of accelerometer samples at once.
+def align_window(window, rollWave, pitchWave):
     """
-    :param axes: x,y,z of current sampled accelerometer axis
-    :return:
+    :param window: list of x,y,z accelerometer samples, oldest first
+    :return: [new waves, rollWave, pitchWave]
     """
-    x = axes['x']
-    y = axes['y']
-    z = axes['z']
+    xs, ys, zs = axesFilter.update_window(window)
 
     retWaves = []
-    # http://stackoverflow.com/questions/3755059/3d-accelerometer-calculate-the-orientation
     # math.atan2(y, x) The result is between -pi and pi.
     # NOTE: formerly switch pitch and roll! Our sensor was wired... strangely.
+    Rolls, Pitches, Magnitudes = orientation.roll_pitch_magnitude_batch(xs, ys, zs)
+    Magnitude = max(Magnitudes)
 
-    Pitch = math.atan2(y, z * 180/math.pi)
-    Roll = math.atan2(-x, math.sqrt(y * y + z * z) * 180/math.pi)
-    Magnitude = GetMagnitude(axes)
-    MaxMagnitude = GetMagnitude({"x":g_tolerance, "y":g_tolerance, "z":g_tolerance})
-
-    print "Roll: ", Roll
-    print "Pitch: ", Pitch
+    print "Roll: ", Rolls[-1]
+    print "Pitch: ", Pitches[-1]
     print "Magnitude: ", Magnitude
     print "MaxMagnitude", MaxMagnitude
 
     # now calculate which wave type this should be.
-    if not (-roll_threshold <= Roll <= roll_threshold):
-        if not ((rollWave - waveAngleIncrement) <= Roll <= (rollWave + waveAngleIncrement)):
-            rollWave = Roll
-            if (0 <= Roll <= math.pi):
-                retWaves.append(Wave("TTB", Magnitude / MaxMagnitude))
-            elif (-math.pi <= Roll <= 0):
-                retWaves.append(Wave("BTT", Magnitude / MaxMagnitude))
-
-    if not (-pitch_threshold <= Pitch <= pitch_threshold):
-        if not ((pitchWave - waveAngleIncrement) <= Pitch <= (pitchWave + waveAngleIncrement)):
-            pitchWave = Pitch
-            if (0 <= Pitch <= math.pi):
-                retWaves.append(Wave("RTL", Magnitude / MaxMagnitude))
-            elif (-math.pi <= Pitch <= 0):
-                retWaves.append(Wave("LTR", Magnitude / MaxMagnitude))
+    Roll, rollWave = orientation.spawn_decision(Rolls, rollWave, roll_threshold, waveAngleIncrement)
+    if Roll is not None:
+        if (0 <= Roll <= math.pi):
+            retWaves.append(Wave("TTB", Magnitude / MaxMagnitude))
+        elif (-math.pi <= Roll <= 0):
+            retWaves.append(Wave("BTT", Magnitude / MaxMagnitude))
+
+    Pitch, pitchWave = orientation.spawn_decision(Pitches, pitchWave, pitch_threshold, waveAngleIncrement)
+    if Pitch is not None:
+        if (0 <= Pitch <= math.pi):
+            retWaves.append(Wave("RTL", Magnitude / MaxMagnitude))
+        elif (-math.pi <= Pitch <= 0):
+            retWaves.append(Wave("LTR", Magnitude / MaxMagnitude))
     stuffarray = [retWaves, rollWave, pitchWave]
     print "Stuff:", stuffarray
     return stuffarray
@@ -251,39 +276,146 @@ parser.add_option('-l', '--layout', dest='layout', default=default_layout,
                     help='layout file')
 parser.add_option('-s', '--server', dest='server', default=default_server,
                     action='store', type='string',
-                    help='ip and port of server')
+                    help='ip and port of server. several servers can be given separated '
+                         'by commas, each optionally followed by @start:end to only send '
+                         'that range of pixels to it')
+parser.add_option('-b', '--background', dest='background', default=False,
+                    action='store_true',
+                    help='send from a background thread so a down server never stalls frames')
+parser.add_option('-u', '--udp', dest='udp', default=False,
+                    action='store_true',
+                    help='send frames as UDP datagrams; late frames are dropped instead of queued')
+parser.add_option('-c', '--per-board', dest='per_board', default=False,
+                    action='store_true',
+                    help='send each fadecandy board on its own OPC channel, and only when it changes')
+parser.add_option('-g', '--hardware-gamma', dest='hardware_gamma', default=0,
+                    action='store', type='float',
+                    help='have the fadecandy boards apply this gamma (and dither/interpolate) '
+                         'instead of doing color correction in python')
+parser.add_option('-m', '--shared-frames', dest='shared_frames', default=None,
+                    action='store', type='string',
+                    help='create a shared memory frame buffer at this path (e.g. /dev/shm/sloshbox) '
+                         'which other processes can write frames into to be composited over ours')
+parser.add_option('-w', '--worker', dest='worker', default=False,
+                    action='store_true',
+                    help='convert, map, encode and send frames in a second process (uses another core)')
+parser.add_option('-a', '--map-layout', dest='map_layout', default=False,
+                    action='store_true',
+                    help='light each LED by sampling the grid at its layout coordinates, '
+                         'instead of through the fadecandy board offsets')
+parser.add_option('-B', '--boards', dest='boards', default=None,
+                    action='store', type='string',
+                    help='JSON file of fadecandy board positions, sizes, rotations and wiring '
+                         '(default: two 8x8 boards side by side)')
+parser.add_option('-d', '--direct', dest='direct', default=False,
+                    action='store_true',
+                    help='render palette colors straight into the OPC payload in board order, '
+                         'skipping the intermediate pixel arrays')
+parser.add_option('-z', '--steady', dest='steady', default=False,
+                    action='store_true',
+                    help='allocate every per-frame buffer once and reuse it, so frames make '
+                         'no new lists, tuples or messages, only float values (implies --direct)')
+parser.add_option('-x', '--byte-field', dest='byte_field', default=False,
+                    action='store_true',
+                    help='keep the field as a bytearray of 0-255 levels and drain, stamp and '
+                         'color it with whole-array byte operations (fast without NumPy)')
+parser.add_option('-D', '--dither', dest='dither', default=0,
+                    action='store', type='int',
+                    help='temporally dither between palette colors over this many frames '
+                         'for smoother fades (implies --direct unless --byte-field or --map-layout '
+                         'is given)')
+parser.add_option('-e', '--effects', dest='effects', default=None,
+                    action='store', type='string',
+                    help='layer several effects, bottom first, as comma separated '
+                         'name[:blend[:opacity]] with names wave, cosine or random and blends '
+                         'add, max, alpha or multiply, e.g. wave,cosine:add:0.3')
+parser.add_option('-t', '--trace-allocations', dest='trace_allocations', default=False,
+                    action='store_true',
+                    help='print how many allocations each frame makes, once a second: the net '
+                         'number of garbage collected objects, or with tracemalloc (pytracemalloc '
+                         'on Python 2) the blocks and peak bytes')
+parser.add_option('-S', '--sim-scale', dest='sim_scale', default=1,
+                    action='store', type='int',
+                    help='run the simulation on a grid this many times coarser than the LEDs '
+                         'and scale it up for output (default 1: full resolution)')
+parser.add_option('--upsample', dest='upsample', default=None,
+                    action='store', type='choice', choices=['bilinear', 'nearest'],
+                    help='how --sim-scale scales the simulation up to the LEDs: bilinear '
+                         '(the default) or nearest. --byte-field can only use nearest')
 parser.add_option('-f', '--fps', dest='fps', default=default_fps,
                     action='store', type='int',
                     help='frames per second')
 
 options, args = parser.parse_args()
 
-if not options.layout:
+# each of these renders and sends frames its own way, so asking for two of them
+# at once would quietly ignore one
+conflictingOptions = [('per_board', 'direct'), ('per_board', 'steady'), ('per_board', 'byte_field'),
+                      ('per_board', 'map_layout'), ('per_board', 'effects'), ('per_board', 'dither'),
+                      ('map_layout', 'direct'), ('map_layout', 'steady'), ('map_layout', 'byte_field'),
+                      ('map_layout', 'effects'),
+                      ('byte_field', 'direct'), ('byte_field', 'steady'),
+                      ('effects', 'steady'),
+                      # a UDP send never waits on the server, and only TCP has a background sender
+                      ('udp', 'background'),
+                      # the worker process renders from normalArray
+                      ('byte_field', 'worker')]
+for first, second in conflictingOptions:
+    if getattr(options, first) and getattr(options, second):
+        parser.print_help()
+        print
+        print 'ERROR: --%s can\'t be used with --%s' % (first.replace('_', '-'), second.replace('_', '-'))
+        print
+        sys.exit(1)
+
+# several servers, or a pixel range, go through a FanoutClient, which only speaks TCP
+if options.udp and (',' in options.server or '@' in options.server):
     parser.print_help()
     print
-    print 'ERROR: you must specify a layout file using --layout'
+    print 'ERROR: --udp sends whole frames to one server; it can\'t fan out to %s' % options.server
     print
     sys.exit(1)
 
-#-------------------------------------------------------------------------------
-# parse layout file
+# the byte field picks one cell per LED with a single gather; blending four
+# would take Python code per pixel
+if options.byte_field and options.upsample == 'bilinear':
+    parser.print_help()
+    print
+    print 'ERROR: --byte-field can only upsample with --upsample nearest'
+    print
+    sys.exit(1)
+if options.upsample is None:
+    options.upsample = 'nearest' if options.byte_field else 'bilinear'
 
-print
-print '    parsing layout file'
-print
+if options.steady or (options.dither and not (options.byte_field or options.map_layout)):
+    options.direct = True
 
-# array representing virtual pixels
-coordinates = []
-for item in json.load(open(options.layout)):
-    if 'point' in item:
-        coordinates.append(tuple(item['point']))
+if not options.layout:
+    parser.print_help()
+    print
+    print 'ERROR: you must specify a layout file using --layout'
+    print
+    sys.exit(1)
 
+#-------------------------------------------------------------------------------
+# fadecandy boards: where each one sits on the grid and how it is wired.
+# the grid is sized to just cover them all (two 8x8 boards: 16x8)
+if options.boards:
+    try:
+        boardSpecs = boards.load_boards(options.boards)
+    except (IOError, ValueError), e:
+        parser.print_help()
+        print
+        print 'ERROR: bad --boards file: %s' % e
+        print
+        sys.exit(1)
+else:
+    boardSpecs = boards.DEFAULT_BOARDS
 
-# use layout "fadecandy8x8.json"
-# Fadecandy 8x8 board
-LED_xsize = 16
-LED_ysize = 8
+LED_xsize, LED_ysize = boards.grid_size(boardSpecs)
 numLEDs = LED_xsize * LED_ysize
+# LEDs actually on the boards; fewer than numLEDs if they leave gaps in the grid
+boardLEDs = sum([spec['width'] * spec['height'] for spec in boardSpecs])
 
 black = [ (0,0,0) ] * numLEDs
 white = [ (255,255,255) ] * numLEDs
@@ -292,22 +424,122 @@ white = [ (255,255,255) ] * numLEDs
 # this array gets translated to the PixelArray for passing to the OPC client.
 normalArray = [[0.0 for x in range(LED_xsize)] for y in range(LED_ysize)]
 
+# Waves run and drain on the simulation grid, simArray. With --sim-scale it is
+# coarser than the LEDs and scaled up into normalArray for output each frame by
+# a precomputed sampling table; otherwise it is normalArray itself.
+# A coarser grid keeps at least 2 cells a side, so waves still travel across it
+if options.sim_scale > 1:
+    SIM_xsize = min(LED_xsize, max(2, int(math.ceil(LED_xsize / options.sim_scale))))
+    SIM_ysize = min(LED_ysize, max(2, int(math.ceil(LED_ysize / options.sim_scale))))
+else:
+    SIM_xsize, SIM_ysize = LED_xsize, LED_ysize
+if (SIM_xsize, SIM_ysize) == (LED_xsize, LED_ysize):
+    simArray = normalArray
+    upsampleTable = None
+else:
+    simArray = [[0.0 for x in range(SIM_xsize)] for y in range(SIM_ysize)]
+    # each LED cell's position, stretched over the simulation grid corner to corner
+    upsampleTable = layout.SamplingTable([(x, y, 0) for y in range(LED_ysize) for x in range(LED_xsize)],
+                                         SIM_xsize, SIM_ysize, 0, 1, options.upsample == 'nearest')
+    simField = [0.0] * (SIM_xsize * SIM_ysize)
+    ledField = [0.0] * numLEDs
+
+# how far a wave moves across simArray each update: one LED, so waves keep the
+# same speed on the LEDs whatever --sim-scale is. The drain per frame is left
+# alone; at one LED per frame it already leaves a trail of 1/drainAmount LEDs
+waveStepX = (SIM_xsize - 1) / (LED_xsize - 1) if LED_xsize > 1 else 1.0
+waveStepY = (SIM_ysize - 1) / (LED_ysize - 1) if LED_ysize > 1 else 1.0
+
+# column indices of simArray, made once rather than by range() every frame
+gridColumns = list(range(SIM_xsize))
+
+#-------------------------------------------------------------------------------
+# parse layout file
+
+print
+print '    parsing layout file'
+print
+
+# array representing virtual pixels, and with --map-layout the per-LED bilinear
+# weights into normalArray. both come from a compiled cache next to the layout
+# file, which is rebuilt whenever the layout changes.
+try:
+    if options.map_layout:
+        coordinates, layoutTable = layout.load_compiled(options.layout, LED_xsize, LED_ysize)
+    else:
+        coordinates, layoutTable = layout.load_compiled(options.layout)
+except (IOError, ValueError), e:
+    print 'ERROR: bad --layout file: %s' % e
+    print
+    sys.exit(1)
 
 #-------------------------------------------------------------------------------
 # connect to server
 
-client = opc.Client(options.server)
-if client.can_connect():
-    print '    connected to %s' % options.server
-else:
-    # can't connect, but keep running in case the server appears later
-    print '    WARNING: could not connect to %s' % options.server
+# a UDP frame (or with --per-board, each board's frame) must fit in a datagram,
+# or every one of them would be dropped
+if options.udp:
+    if options.per_board:
+        udpPixels = max([spec['width'] * spec['height'] for spec in boardSpecs])
+    else:
+        udpPixels = boardLEDs
+    if udpPixels > opc.UDPClient.max_pixels_for():
+        print
+        print 'ERROR: a %d pixel frame doesn\'t fit in one UDP datagram (at most %d pixels); ' \
+              'use --per-board with smaller boards, or TCP' % (udpPixels, opc.UDPClient.max_pixels_for())
+        print
+        sys.exit(1)
+
+def connect_client():
+    if ',' in options.server or '@' in options.server:
+        client = opc.FanoutClient(opc.parse_targets(options.server))
+    elif options.udp:
+        client = opc.UDPClient(options.server)
+    elif options.background:
+        client = opc.BackgroundClient(options.server)
+    else:
+        client = opc.Client(options.server)
+    if client.can_connect():
+        print '    connected to %s' % options.server
+    else:
+        # can't connect, but keep running in case the server appears later
+        print '    WARNING: could not connect to %s' % options.server
+
+    if options.hardware_gamma:
+        client.set_color_correction(gamma=options.hardware_gamma)
+        client.set_firmware_config(dithering=fc_dithering, interpolation=fc_interpolation)
+    return client
+
+# with --worker the render worker process makes its own connection
+client = None
+if not options.worker:
+    client = connect_client()
+
+#-------------------------------------------------------------------------------
+# shared memory frames from external effect processes
+
+sharedFrames = None
+if options.shared_frames:
+    sharedFrames = framebuffer.SharedFrameReader(
+        framebuffer.SharedFrameBuffer(options.shared_frames, boardLEDs, create=True))
+    print '    external frames can be written to %s' % options.shared_frames
 
 #-------------------------------------------------------------------------------
 # initialize accelerometer
 if RUNNINGONRPI:
     # uncomment this when running on the RPI - can't use smbus
     accelerometer = adxl345.ADXL345()
+    # drops the sensor's data rate while the box is at rest, raises it while sloshing
+    accelRate = adxl345.RateController(accelerometer)
+    # lets the idle loop poll one status register instead of reading every axis,
+    # but only if the chip can wake on a tilt smaller than the smallest one that
+    # spawns a wave; its activity threshold comes in 62.5 mg steps, so with
+    # finer thresholds than that the axes are read at the rest rate instead
+    spawnTilt_g = math.sin(min(roll_threshold, pitch_threshold, waveAngleIncrement))
+    wake_g = math.floor(spawnTilt_g / adxl345.THRESH_SCALE_G) * adxl345.THRESH_SCALE_G
+    gateOnActivity = wake_g > 0
+    if gateOnActivity:
+        accelerometer.enableActivityDetection(act_g=wake_g, inact_g=wake_g)
     print
 
 #-------------------------------------------------------------------------------
@@ -337,20 +569,28 @@ def pixel_color(t, coord, ii):
 
     return (r*256, g*256, b*256)
 
+#-------------------------------------------------------------------------------
+# True once every element in simArray has drained to 0
+def normalsEmpty():
+    if byteField is not None:
+        return byteField.empty()
+    for row in simArray:
+        if any(row):
+            return False
+    return True
+
 #-------------------------------------------------------------------------------
 # Drain the normals of each element in handleArray by amount, clamp to 0
 def drainNormals(amount):
-    # Now find its dimensions
-    rows = len(normalArray)
-    cols = len(normalArray[0])
-
-    # loop over every element
-    for row in range(rows):
-        for col in range(cols):
-            tmp = normalArray[row][col] - amount
-            if tmp < 0:
-                tmp = 0
-            normalArray[row][col] = tmp
+    # loop over every element, leaving drained ones alone
+    for row in simArray:
+        for col in gridColumns:
+            tmp = row[col]
+            if tmp:
+                tmp -= amount
+                if tmp < 0:
+                    tmp = 0
+                row[col] = tmp
 
 #-------------------------------------------------------------------------------
 # Make a pixel array from coordinate set
@@ -365,54 +605,77 @@ def make_pixelarray(coordinates, t):
 class FadeCandy(object):
     """
     Define a single Fadecandy board virtual object for mapping from pixelarray.
+
+    The board covers a block of the pixel grid with its top left corner at
+    (x, y). xsize x ysize is the board's own size in LEDs, as wired: LED 0
+    first, along a row of xsize LEDs, then the next row.
+    serpentine: every other row is wired back the other way.
+    flip_x, flip_y: mirror the board along its rows / columns.
+    rotation: 0, 90, 180 or 270 degrees clockwise. at 90 and 270 the block
+    covered on the grid is ysize wide and xsize tall.
+
+    All of that is compiled once, in __init__, into self.order (using
+    boards.board_cells()): the grid (row, col) each LED reads from, in
+    wiring order.
     """
-    def __init__(self, x=0, y=0, id=0):
+    def __init__(self, x=0, y=0, id=0, channel=None, xsize=8, ysize=8,
+                 rotation=0, flip_x=False, flip_y=False, serpentine=False):
         self.ID = id
-
+        # OPC channel this board listens on when sending per board (--per-board)
+        if channel is None:
+            channel = id + 1
+        self.channel = channel
+
+        # raises ValueError for a negative position or a bad rotation
+        self.spec = boards.board_spec({'x': x, 'y': y, 'width': xsize, 'height': ysize,
+                                       'rotation': rotation, 'flip_x': flip_x, 'flip_y': flip_y,
+                                       'serpentine': serpentine, 'channel': channel})
         self.x = x
         self.y = y
-        self.xsize = 8
-        self.ysize = 8
-        self.array = [[0 for y in range(self.ysize)] for x in range(self.xsize)]
+        self.xsize = xsize
+        self.ysize = ysize
+        self.rotation = self.spec['rotation']
+        self.flip_x = flip_x
+        self.flip_y = flip_y
+        self.serpentine = serpentine
+
+        self.order = self.CompileOrder()
+        self.pixels = [color_black] * len(self.order)
+
+    def CompileOrder(self):
+        """
+        works out which grid (row, col) each LED on the board reads from
+        :return: list of (row, col) in wiring order, None where the LED is outside the grid
+        """
+        order = []
+        for row, col in boards.board_cells(self.spec):
+            if 0 <= row < LED_ysize and 0 <= col < LED_xsize:
+                order.append((row, col))
+            else:
+                # mapped coordinates are outside targetarray
+                order.append(None)
+        return order
 
     def Map(self, targetArray):
         """
-        copies pixels from the targetArray into self array
+        copies pixels from the targetArray into self pixels, in wiring order
         :param targetArray:
         :return:
         """
-        # print "Map: ({0}, {1}) -> {2}, {3}".format(len(targetArray), len(targetArray[0]), self.x, self.y)
-
-        for ii in range(self.ysize):
-            #row
-            for jj in range(self.xsize):
-                #col
-                # print "Mapping: target({0},{1})={2} -> self({3},{4})".format(self.y+ii, self.x+jj, targetArray[self.y+ii][self.x+jj], ii, jj)
-                if ((self.y + ii) < len(targetArray)):
-                    if ((self.x + jj) < len(targetArray[0])):
-                        self.array[ii][jj] = targetArray[(self.y + ii)][(self.x + jj)]
-                    else:
-                        # mapped coordinates are outside targetarray
-                        self.array[ii][jj] = color_white
-                else:
-                    # mapped coordinates are outside targetarray
-                    self.array[ii][jj] = color_white
+        pixels = self.pixels
+        for ii, cell in enumerate(self.order):
+            if cell is None:
+                pixels[ii] = color_white
+            else:
+                pixels[ii] = targetArray[cell[0]][cell[1]]
 
     def serialize(self):
-        retlist = []
+        return self.pixels
 
-        for i in range(len(self.array)):
-            for j in range(len(self.array[i])):
-                retlist.append(self.array[i][j])
-
-        return retlist
-
-FadeCandyList = []
-nextFadeCandyID = 0
-FadeCandyList.append(FadeCandy(0,0, nextFadeCandyID))
-
-nextFadeCandyID += 1
-FadeCandyList.append(FadeCandy(8,0, nextFadeCandyID))
+FadeCandyList = [FadeCandy(spec['x'], spec['y'], ii, channel=spec['channel'],
+                           xsize=spec['width'], ysize=spec['height'], rotation=spec['rotation'],
+                           flip_x=spec['flip_x'], flip_y=spec['flip_y'], serpentine=spec['serpentine'])
+                 for ii, spec in enumerate(boardSpecs)]
 
 #-------------------------------------------------------------------------------
 # Make a pixel array from normals, corresponding to coordinate set
@@ -448,16 +711,80 @@ def make_pixelarray_from_normals(coordinates):
     return serialized_array
 
 #-------------------------------------------------------------------------------
-# For each point in a line, set corresponding point in normalArray to 1.0
+# Make a pixel array in wiring order by sampling normals at each layout point.
+# layoutTable's rows are put in the boards' wiring order at startup (see
+# wireOrderedTable()), so --map-layout lights the same LEDs as the board mapping.
+
+def make_pixelarray_from_layout():
+    field = [norm for row in normalArray for norm in row]
+    if ditherer is not None:
+        return [ditherer.color(min(255, max(0, int(norm * 255 + 0.5))), ii)
+                for ii, norm in enumerate(layoutTable.sample(field))]
+    return [convertNormalToPixel(norm) for norm in layoutTable.sample(field)]
+
+#-------------------------------------------------------------------------------
+# Make a (channel, pixels) pair per fadecandy board from normals
+
+def make_channel_pixels_from_normals():
+    pixel_array = convert2dListToPixels(normalArray)
+
+    channel_pixels = []
+    offset = 0
+    for fc in FadeCandyList:
+        fc.Map(pixel_array)
+        pixels = composite_shared_frame(fc.serialize(), offset)
+        channel_pixels.append((fc.channel, pixels))
+        offset += len(pixels)
+
+    return channel_pixels
+
+#-------------------------------------------------------------------------------
+# Composite the latest externally written frame (if any) over our pixels.
+# offset is the index of pixels[0] in the whole serialized frame.
+
+def composite_shared_frame(pixels, offset=0):
+    if sharedFrames is None:
+        return pixels
+    external = sharedFrames.latest()
+    if external is None:
+        return pixels
+
+    composited = []
+    for ii, (r, g, b) in enumerate(pixels):
+        jj = (offset + ii) * 3
+        if jj + 3 > len(external):
+            composited.append((r, g, b))
+        else:
+            composited.append((max(r, external[jj]), max(g, external[jj + 1]), max(b, external[jj + 2])))
+    return composited
+
+#-------------------------------------------------------------------------------
+# For each point in a line, set corresponding point in simArray to 1.0
 def applyNormalPoints(line):
     for point in line:
         x = point[0]
         y = point[1]
-        x = clamp(0,x,LED_xsize-1)
-        y = clamp(0,y,LED_ysize-1)
+        x = clamp(0,x,SIM_xsize-1)
+        y = clamp(0,y,SIM_ysize-1)
         x = int(x)
         y = int(y)
-        normalArray[y][x] = 1.0
+        simArray[y][x] = 1.0
+
+#-------------------------------------------------------------------------------
+# Set the cells under a wave's line to 1.0 in place. Waves are lines straight
+# across or down the grid, so that is a whole row or column of simArray and
+# no list of points needs to be made; anything else goes through getLine().
+def stampWave(wave):
+    if wave.x1 == wave.x2:
+        col = int(clamp(0, wave.x1, SIM_xsize-1))
+        for row in simArray:
+            row[col] = 1.0
+    elif wave.y1 == wave.y2:
+        row = simArray[int(clamp(0, wave.y1, SIM_ysize-1))]
+        for col in gridColumns:
+            row[col] = 1.0
+    else:
+        applyNormalPoints(pytweening.getLine(wave.x1, wave.y1, wave.x2, wave.y2))
 
 #-------------------------------------------------------------------------------
 # Convert a normal value to a pixel color
@@ -479,6 +806,245 @@ def convertNormalToPixel(norm):
 
     return rgb
 
+#-------------------------------------------------------------------------------
+# The palette as a gradient for --dither: the normal at which each color starts
+# in convertNormalToPixel(). Normals in between are dithered between colors.
+paletteStops = [(0.0, color_black),
+                (0.2, color_04),
+                (0.4, color_03),
+                (0.6, color_02),
+                (0.8, color_01),
+                (1.0, color_white)]
+
+ditherer = None
+if options.dither:
+    ditherer = dither.TemporalDither(paletteStops, options.dither)
+
+#-------------------------------------------------------------------------------
+# Direct-to-wire rendering (--direct): palette colors are written as bytes
+# straight into the OPC payload, in board (wiring) order.
+
+# r,g,b bytes of every color convertNormalToPixel() can return
+paletteBytes = dict((color, bytes(bytearray(color)))
+                    for color in (color_white, color_01, color_02, color_03, color_04, color_black))
+
+# grid (row, col) of every LED on every board, in the order they go on the wire
+wireOrder = [cell for fc in FadeCandyList for cell in fc.order]
+wirePayload = bytearray(len(wireOrder) * 3)
+
+# --map-layout samples the grid at each layout point, but frames go out in the
+# boards' wiring order, whatever order the layout file lists its points in. So
+# the table's rows are put in wiring order once: row ii is the layout point on
+# wired LED ii, the one that mostly samples that LED's cell. An LED with no
+# layout point samples its own cell, as the board mapping does.
+def wireOrderedTable(table):
+    taps = layout.SamplingTable.TAPS
+    pointsAt = {}
+    for ii in range(table.n_points):
+        weights = list(table.weights[ii * taps:(ii + 1) * taps])
+        index = table.indices[ii * taps + weights.index(max(weights))]
+        pointsAt.setdefault((index // table.grid_width, index % table.grid_width), []).append(ii)
+
+    indices = array.array('i')
+    weights = array.array('f')
+    missing = 0
+    for cell in wireOrder:
+        points = pointsAt.get(cell)
+        if points:
+            ii = points.pop(0)
+            indices.extend(table.indices[ii * taps:(ii + 1) * taps])
+            weights.extend(table.weights[ii * taps:(ii + 1) * taps])
+        else:
+            missing += 1
+            indices.extend([cell[0] * table.grid_width + cell[1] if cell else 0] * taps)
+            weights.extend([1.0 if cell else 0.0] + [0.0] * (taps - 1))
+    unused = sum(len(points) for points in pointsAt.values())
+
+    if missing:
+        print '    WARNING: %d of the boards\' LEDs have no layout point and light from ' \
+              'their own grid cell' % missing
+    if unused:
+        print '    WARNING: %d layout points are on no board LED and are left out' % unused
+    return layout.SamplingTable.from_arrays(table.grid_width, table.grid_height, indices, weights)
+
+if layoutTable:
+    layoutTable = wireOrderedTable(layoutTable)
+
+def render_direct(payload, start=0):
+    if ditherer is not None:
+        return render_direct_dithered(payload, start)
+    offset = start
+    for cell in wireOrder:
+        if cell is None:
+            # mapped coordinates are outside the grid
+            payload[offset:offset + 3] = paletteBytes[color_white]
+        else:
+            payload[offset:offset + 3] = paletteBytes[convertNormalToPixel(normalArray[cell[0]][cell[1]])]
+        offset += 3
+    return payload
+
+# render_direct() through the dither tables; neighbouring LEDs are a phase apart.
+# Each wired LED's level goes into one reused bytearray, which the ditherer
+# colors with a bytes.translate() per phase and channel, as the byte field does.
+# An LED outside the grid reads a row that is always full, so it shows white.
+wireRows = [(normalArray[cell[0]], cell[1]) if cell is not None else ([1.0], 0) for cell in wireOrder]
+wireLevels = bytearray(len(wireOrder))
+
+def render_direct_dithered(payload, start=0):
+    levels = wireLevels
+    ii = 0
+    for row, col in wireRows:
+        levels[ii] = min(255, int(row[col] * 255 + 0.5))
+        ii += 1
+    return ditherer.render(levels, payload, start)
+
+# Composite the latest externally written frame (if any) over a payload, in place
+def composite_shared_payload(payload):
+    if sharedFrames is None:
+        return payload
+    external = sharedFrames.latest()
+    if external is None:
+        return payload
+    count = min(len(payload), len(external))
+    payload[:count] = bytearray(map(max, payload[:count], external[:count]))
+    return payload
+
+#-------------------------------------------------------------------------------
+# Scaling the simulation grid up to the LEDs (--sim-scale)
+
+# Fill normalArray from simArray through the precomputed upsampleTable
+def upsampleField():
+    ii = 0
+    for row in simArray:
+        simField[ii:ii + SIM_xsize] = row
+        ii += SIM_xsize
+    upsampleTable.sample(simField, ledField)
+    ii = 0
+    for row in normalArray:
+        row[:] = ledField[ii:ii + LED_xsize]
+        ii += LED_xsize
+
+# The simArray cell nearest to a normalArray (row, col) cell, or None for None
+def simCellFor(cell):
+    if cell is None:
+        return None
+    row, col = cell
+    return (int(math.floor(row * (SIM_ysize - 1) / max(1, LED_ysize - 1) + 0.5)),
+            int(math.floor(col * (SIM_xsize - 1) / max(1, LED_xsize - 1) + 0.5)))
+
+#-------------------------------------------------------------------------------
+# Byte field rendering (--byte-field): the field is kept as 0-255 levels in a
+# bytearray instead of normalArray, and every step is a whole-array operation.
+
+byteField = None
+if options.byte_field:
+    byteField = bytefield.ByteField(SIM_xsize, SIM_ysize)
+    byteField.set_drain(drainAmount)
+    byteField.set_palette(convertNormalToPixel)
+    # with --sim-scale, each LED is gathered straight from its nearest
+    # simulation cell, so scaling up costs nothing extra
+    byteField.set_wire_order([simCellFor(cell) for cell in wireOrder])
+    byteField.set_dither(ditherer)
+
+# stampWave() for the byte field
+def stampWaveBytes(wave):
+    if wave.x1 == wave.x2:
+        byteField.stamp_column(int(clamp(0, wave.x1, SIM_xsize-1)))
+    elif wave.y1 == wave.y2:
+        byteField.stamp_row(int(clamp(0, wave.y1, SIM_ysize-1)))
+    else:
+        byteField.stamp_points(pytweening.getLine(wave.x1, wave.y1, wave.x2, wave.y2))
+
+#-------------------------------------------------------------------------------
+# Layered effects (--effects): each effect renders a whole frame of r,g,b bytes
+# in wiring order and a compositor.Compositor blends them.
+
+# Pack a list of (r, g, b) pixels into a payload, clamping each channel to 0-255
+def pixels_to_payload(pixels):
+    return bytearray([int(min(255, max(0, c))) for pixel in pixels for c in pixel])
+
+def wave_layer(t):
+    if byteField is not None:
+        return byteField.render()
+    return render_direct(wirePayload)
+
+# Layout position of every wired LED: its grid cell put back on the layout's
+# bounding box, undoing the stretch layout.SamplingTable does, so the cosine
+# layer comes out in wiring order whatever order the layout lists its points
+# in. An LED outside the grid takes the box's corner, and with no layout points
+# to go by the LEDs are spread over a unit square.
+def wire_coordinates():
+    if len(coordinates):
+        across, down = layout.widest_axes(coordinates)
+        lows = [min(point[axis] for point in coordinates) for axis in range(3)]
+        highs = [max(point[axis] for point in coordinates) for axis in range(3)]
+    else:
+        across, down = 0, 2
+        lows, highs = [0.0] * 3, [1.0] * 3
+    points = []
+    for cell in wireOrder:
+        row, col = cell if cell is not None else (0, 0)
+        point = [(low + high) / 2 for low, high in zip(lows, highs)]
+        point[across] = lows[across] + (highs[across] - lows[across]) * col / max(1, LED_xsize - 1)
+        point[down] = lows[down] + (highs[down] - lows[down]) * row / max(1, LED_ysize - 1)
+        points.append(tuple(point))
+    return points
+
+# set from wire_coordinates() when --effects is given
+wireCoordinates = None
+
+def cosine_layer(t):
+    return pixels_to_payload(make_pixelarray(wireCoordinates, t))
+
+def random_layer(t):
+    return pixels_to_payload(make_pixels_random(len(wireOrder)))
+
+effectLayers = {'wave': wave_layer, 'cosine': cosine_layer, 'random': random_layer}
+
+# Build a Compositor from an --effects list, raising ValueError if it's bad
+def parse_effects(spec):
+    layers = compositor.Compositor(len(wireOrder))
+    for effect in spec.split(','):
+        fields = effect.strip().split(':')
+        if fields[0] not in effectLayers:
+            raise ValueError('unknown effect %r, expected one of %s' % (
+                fields[0], ', '.join(sorted(effectLayers))))
+        blend = fields[1] if len(fields) > 1 else 'max'
+        opacity = float(fields[2]) if len(fields) > 2 else 1.0
+        layers.add(compositor.Layer(effectLayers[fields[0]], blend, opacity, name=fields[0]))
+    return layers
+
+effects = None
+if options.effects:
+    wireCoordinates = wire_coordinates()
+    try:
+        effects = parse_effects(options.effects)
+    except ValueError, e:
+        parser.print_help()
+        print
+        print 'ERROR: bad --effects: %s' % e
+        print
+        sys.exit(1)
+
+# True if an effect other than the waves is drawn, so there's never nothing to show
+def effectsAnimate():
+    return effects is not None and any(layer.name != 'wave' for layer in effects.active())
+
+#-------------------------------------------------------------------------------
+# Steady-state rendering (--steady): the whole OPC message, header included, is
+# allocated once and rendered into in place every frame.
+
+steadyMessage = bytearray([channel, 0, len(wirePayload) >> 8, len(wirePayload) & 0xFF]) + wirePayload
+
+def send_steady(client):
+    render_direct(steadyMessage, 4)
+    if sharedFrames is not None or isinstance(client, (opc.BackgroundClient, opc.FanoutClient)):
+        # compositing makes a new frame anyway, and queued messages must not
+        # change under the sender thread, so these go the copying way
+        client.put_payload(composite_shared_payload(steadyMessage[4:]), channel)
+    else:
+        client.put_message(steadyMessage)
+
 def getNormalFor(coord):
     x,y,z = coord
     norm = normalArray[y][x]
@@ -541,9 +1107,95 @@ def GetMagnitude(axes):
     x = (axes['x'])
     y = (axes['y'])
     z = (axes['z'])
-    magnitude  = math.sqrt(math.pow(x,2) + math.pow(y,2) + math.pow(z,2))
+    magnitude  = math.sqrt(x * x + y * y + z * z)
     return magnitude
 
+#-------------------------------------------------------------------------------
+# Convert normalArray to pixels and push them to the client.
+
+def send_frame(client):
+    if effects is not None:
+        client.put_payload(composite_shared_payload(effects.render(time.time() - start_time)), channel)
+    elif byteField is not None:
+        client.put_payload(composite_shared_payload(byteField.render()), channel)
+    elif layoutTable:
+        # the table's rows are in wiring order, so no board mapping is needed
+        client.put_pixels(composite_shared_frame(make_pixelarray_from_layout()), channel)
+    elif options.steady:
+        send_steady(client)
+    elif options.direct:
+        client.put_payload(composite_shared_payload(render_direct(wirePayload)), channel)
+    elif options.per_board:
+        # only boards whose pixels changed are sent
+        client.put_channels(make_channel_pixels_from_normals())
+    else:
+        # calculate pixel color values based on normalArray
+        pixels = make_pixelarray_from_normals(coordinates)
+        #pixels = make_pixels_random(numLEDs)
+        pixels = composite_shared_frame(pixels)
+
+        ## Create pixel array and push to client.
+        # pixels = make_pixelarray(coordinates, t)
+        client.put_pixels(pixels, channel)
+
+    if ditherer:
+        ditherer.advance()
+
+#-------------------------------------------------------------------------------
+# Out of process render worker (--worker)
+
+class RenderWorker(object):
+    """
+    Runs send_frame() in a forked worker process, so palette conversion, board
+    mapping, OPC encoding and sending use a second core while the simulation
+    keeps this one.
+
+    The normal fields are exchanged through two shared memory slots. publish()
+    copies normalArray into the slot the worker isn't reading and bumps the
+    sequence counter; the worker copies the newest slot back into its own
+    normalArray, retrying if the counter moved while it copied, and sends it.
+    Frames the worker is too slow for are skipped, never queued.
+    """
+    def __init__(self):
+        cells = LED_xsize * LED_ysize
+        self.fields = multiprocessing.Array('d', 2 * cells, lock=False)
+        self.seq = multiprocessing.Value('L', 0, lock=False)
+        self.ready = multiprocessing.Event()
+        self.parent_pid = os.getpid()
+        self.process = multiprocessing.Process(target=self.run, name='sloshbox-render')
+        self.process.daemon = True
+        self.process.start()
+
+    def publish(self):
+        seq = self.seq.value + 1
+        start = (seq & 1) * LED_xsize * LED_ysize
+        for row in normalArray:
+            self.fields[start:start + LED_xsize] = row
+            start += LED_xsize
+        self.seq.value = seq
+        self.ready.set()
+
+    def run(self):
+        # runs in the worker process, with its own copy of normalArray
+        client = connect_client()
+        while True:
+            if not self.ready.wait(1.0):
+                if os.getppid() != self.parent_pid:
+                    # the simulation process is gone
+                    return
+                continue
+            self.ready.clear()
+            seq = self.seq.value
+            while True:
+                start = (seq & 1) * LED_xsize * LED_ysize
+                for row in normalArray:
+                    row[:] = self.fields[start:start + LED_xsize]
+                    start += LED_xsize
+                if self.seq.value == seq:
+                    break
+                seq = self.seq.value
+            send_frame(client)
+
 #-------------------------------------------------------------------------------
 # core pixel loop
 
@@ -562,6 +1214,21 @@ LastWaveCreatedAt = start_time
 waveList =[Wave()]
 accel_axes = sample_accel_FAKE({"x": 0, "y": 0, "z": 0})
 
+allocationCounter = None
+if options.trace_allocations:
+    allocationCounter = allocations.AllocationCounter(options.fps)
+
+renderWorker = None
+if options.worker:
+    renderWorker = RenderWorker()
+
+# True while the main loop is idling
+idle = False
+
+# accelerometer samples collected since the last spawn check
+accel_window = []
+LastSampleAt = start_time
+
 # last angle at which we generated a wave
 lastPitchWave = 0
 lastRollWave = 0
@@ -571,18 +1238,33 @@ while True:
     # update time since loop began
     t = time.time() - start_time
 
-    # if wave timer is reached, check accelerometer and spawn a new wave.
-    wave_spawn_timer = time.time() - LastWaveCreatedAt
-
-    if wave_spawn_timer >= wave_spawn_period:
-        if RUNNINGONRPI:
+    # collect accelerometer samples, spread evenly over the spawn period
+    # (only one per period while the sensor reports the box is at rest)
+    sample_period = wave_spawn_period / accel_window_size
+    if RUNNINGONRPI and not accelRate.active:
+        sample_period = wave_spawn_period
+    if (time.time() - LastSampleAt) >= sample_period:
+        if RUNNINGONRPI and idle and gateOnActivity and not accelerometer.pollActivity():
+            # the sensor still reports inactivity; skip the full axis read
+            pass
+        elif RUNNINGONRPI:
             accel_axes = sample_accel()
+            accelRate.update(accel_axes)
+            accel_window.append(accel_axes)
             print
         else:
             accel_axes = sample_accel_FAKE(accel_axes)
+            accel_window.append(accel_axes)
+        LastSampleAt = time.time()
+
+    # if wave timer is reached, check accelerometer and spawn a new wave.
+    wave_spawn_timer = time.time() - LastWaveCreatedAt
+
+    if wave_spawn_timer >= wave_spawn_period and accel_window:
         stuff = []
         new_Waves = []
-        stuff = align(accel_axes, lastRollWave, lastPitchWave)
+        stuff = align_window(accel_window, lastRollWave, lastPitchWave)
+        accel_window = []
         print "RECV Stuff:", stuff
         new_Waves = stuff[0]
         lastRollWave = stuff[1]
@@ -597,6 +1279,23 @@ while True:
         LastWaveCreatedAt = time.time()
         wave_spawn_timer = 0.0
 
+    # idle: no waves left and the field has drained, so every frame would be the
+    # same black frame we already sent. Sleep until the next accelerometer sample
+    # instead; a sample that spawns a wave renders in the same pass.
+    if idle_when_still and not waveList and normalsEmpty() and not effectsAnimate() and \
+            (sharedFrames is None or sharedFrames.latest() is None):
+        if not idle:
+            print "    idle (box at rest)"
+            idle = True
+        time.sleep(max(1 / options.fps, LastSampleAt + sample_period - time.time()))
+        continue
+    elif idle:
+        print "    waking up"
+        idle = False
+
+    if allocationCounter:
+        allocationCounter.start()
+
     for wave in waveList:
         wave.TimerUpdate()
         if wave.delete_flag:
@@ -604,18 +1303,28 @@ while True:
             waveList.remove(wave)
 
         # create the correct line.
-        line = pytweening.getLine(wave.x1, wave.y1, wave.x2, wave.y2)
-        applyNormalPoints(line)
+        if byteField is not None:
+            stampWaveBytes(wave)
+        elif options.steady:
+            stampWave(wave)
+        else:
+            line = pytweening.getLine(wave.x1, wave.y1, wave.x2, wave.y2)
+            applyNormalPoints(line)
 
     # drain normal values
-    drainNormals(drainAmount)
+    if byteField is not None:
+        byteField.drain()
+    else:
+        drainNormals(drainAmount)
+        if upsampleTable:
+            upsampleField()
 
-    # calculate pixel color values based on normalArray
-    pixels = make_pixelarray_from_normals(coordinates)
-    #pixels = make_pixels_random(numLEDs)
+    if renderWorker:
+        renderWorker.publish()
+    else:
+        send_frame(client)
 
-    ## Create pixel array and push to client.
-    # pixels = make_pixelarray(coordinates, t)
-    client.put_pixels(pixels, channel)
+    if allocationCounter:
+        allocationCounter.stop()
 
     time.sleep(1 / options.fps)
\ No newline at end of file
@@ -7,20 +7,30 @@
 # the Adafruit Triple Axis ADXL345 breakout board:
 # http://shop.pimoroni.com/products/adafruit-triple-axis-accelerometer
 
-import smbus
-from time import sleep
+from time import sleep, time
 
-# select the correct i2c bus for this revision of Raspberry Pi
-revision = ([l[12:-1] for l in open('/proc/cpuinfo','r').readlines() if l[:8]=="Revision"]+['0000'])[0]
-bus = smbus.SMBus(1 if int(revision, 16) >= 4 else 0)
+# select the correct i2c bus for this revision of Raspberry Pi.
+# without smbus (i.e. not on a Pi) pass an i2c_bus, e.g. FakeSMBus(), to ADXL345()
+try:
+    import smbus
+    revision = ([l[12:-1] for l in open('/proc/cpuinfo','r').readlines() if l[:8]=="Revision"]+['0000'])[0]
+    bus = smbus.SMBus(1 if int(revision, 16) >= 4 else 0)
+except ImportError:
+    bus = None
 
 # ADXL345 constants
 EARTH_GRAVITY_MS2   = 9.80665
 SCALE_MULTIPLIER    = 0.004
 
+THRESH_ACT          = 0x24
+THRESH_INACT        = 0x25
+TIME_INACT          = 0x26
+ACT_INACT_CTL       = 0x27
 DATA_FORMAT         = 0x31
 BW_RATE             = 0x2C
 POWER_CTL           = 0x2D
+INT_ENABLE          = 0x2E
+INT_SOURCE          = 0x30
 
 BW_RATE_1600HZ      = 0x0F
 BW_RATE_800HZ       = 0x0E
@@ -29,6 +39,8 @@ BW_RATE_200HZ       = 0x0C
 BW_RATE_100HZ       = 0x0B
 BW_RATE_50HZ        = 0x0A
 BW_RATE_25HZ        = 0x09
+BW_RATE_12_5HZ      = 0x08
+BW_RATE_6_25HZ      = 0x07
 
 RANGE_2G            = 0x00
 RANGE_4G            = 0x01
@@ -36,33 +48,95 @@ RANGE_8G            = 0x02
 RANGE_16G           = 0x03
 
 MEASURE             = 0x08
+LINK                = 0x20
 AXES_DATA           = 0x32
 
+# ACT_INACT_CTL bits
+ACT_AC_COUPLED      = 0x80
+ACT_XYZ             = 0x70
+INACT_AC_COUPLED    = 0x08
+INACT_XYZ           = 0x07
+
+# INT_ENABLE / INT_SOURCE bits
+INT_ACTIVITY        = 0x10
+INT_INACTIVITY      = 0x08
+
+THRESH_SCALE_G      = 0.0625    # THRESH_ACT/THRESH_INACT: 62.5 mg per LSB
+
 class ADXL345:
 
     address = None
 
-    def __init__(self, address = 0x53):        
+    def __init__(self, address = 0x53, rate_flag = BW_RATE_100HZ, range_flag = RANGE_2G, i2c_bus = None):
         self.address = address
-        self.setBandwidthRate(BW_RATE_100HZ)
-        self.setRange(RANGE_2G)
+        self.bus = i2c_bus if i2c_bus is not None else bus
+        self.power_ctl = MEASURE
+        self.active = True
+        self.setBandwidthRate(rate_flag)
+        self.setRange(range_flag)
         self.enableMeasurement()
 
     def enableMeasurement(self):
-        bus.write_byte_data(self.address, POWER_CTL, MEASURE)
+        self.bus.write_byte_data(self.address, POWER_CTL, self.power_ctl)
 
     def setBandwidthRate(self, rate_flag):
-        bus.write_byte_data(self.address, BW_RATE, rate_flag)
+        self.bus.write_byte_data(self.address, BW_RATE, rate_flag)
+
+    # activity fires when any enabled axis moves more than this many g
+    def setActivityThreshold(self, g):
+        value = max(0, min(255, int(round(g / THRESH_SCALE_G))))
+        self.bus.write_byte_data(self.address, THRESH_ACT, value)
+
+    # inactivity fires when every enabled axis stays under this many g...
+    def setInactivityThreshold(self, g):
+        value = max(0, min(255, int(round(g / THRESH_SCALE_G))))
+        self.bus.write_byte_data(self.address, THRESH_INACT, value)
+
+    # ...for this many seconds (0-255)
+    def setInactivityTime(self, seconds):
+        value = max(0, min(255, int(seconds)))
+        self.bus.write_byte_data(self.address, TIME_INACT, value)
+
+    # choose the axes and ac/dc coupling used for activity and inactivity
+    def setActivityControl(self, act_axes = ACT_XYZ, inact_axes = INACT_XYZ, ac_coupled = True):
+        value = (act_axes & ACT_XYZ) | (inact_axes & INACT_XYZ)
+        if ac_coupled:
+            value |= ACT_AC_COUPLED | INACT_AC_COUPLED
+        self.bus.write_byte_data(self.address, ACT_INACT_CTL, value)
+
+    # configure activity/inactivity detection and link the two, so the chip
+    # alternates between reporting activity and inactivity
+    def enableActivityDetection(self, act_g = 0.1875, inact_g = 0.125, inact_seconds = 2):
+        self.setActivityThreshold(act_g)
+        self.setInactivityThreshold(inact_g)
+        self.setInactivityTime(inact_seconds)
+        self.setActivityControl()
+        value = self.bus.read_byte_data(self.address, INT_ENABLE)
+        self.bus.write_byte_data(self.address, INT_ENABLE, value | INT_ACTIVITY | INT_INACTIVITY)
+        self.power_ctl |= LINK
+        self.enableMeasurement()
+        self.active = True
+
+    # cheap single register read of INT_SOURCE: returns True while the chip
+    # last reported activity, False once it has reported inactivity.
+    # reading INT_SOURCE clears the activity/inactivity flags.
+    def pollActivity(self):
+        source = self.bus.read_byte_data(self.address, INT_SOURCE)
+        if source & INT_ACTIVITY:
+            self.active = True
+        elif source & INT_INACTIVITY:
+            self.active = False
+        return self.active
 
     # set the measurement range for 10-bit readings
     def setRange(self, range_flag):
-        value = bus.read_byte_data(self.address, DATA_FORMAT)
+        value = self.bus.read_byte_data(self.address, DATA_FORMAT)
 
         value &= ~0x0F;
         value |= range_flag;  
         value |= 0x08;
 
-        bus.write_byte_data(self.address, DATA_FORMAT, value)
+        self.bus.write_byte_data(self.address, DATA_FORMAT, value)
     
     # returns the current reading from the sensor for each axis
     #
@@ -70,7 +144,7 @@ class ADXL345:
     #    False (default): result is returned in m/s^2
     #    True           : result is returned in gs
     def getAxes(self, gforce = False):
-        bytes = bus.read_i2c_block_data(self.address, AXES_DATA, 6)
+        bytes = self.bus.read_i2c_block_data(self.address, AXES_DATA, 6)
         
         x = bytes[0] | (bytes[1] << 8)
         if(x & (1 << 16 - 1)):
@@ -99,6 +173,81 @@ class ADXL345:
 
         return {"x": x, "y": y, "z": z}
 
+class RateController:
+    """Switch the sensor's output data rate to follow how much it is moving.
+
+    Feed every sample (in g) to update().  As soon as any axis changes by more
+    than threshold between samples the sensor is switched to active_rate; once
+    it has been still for rest_after seconds it drops back to rest_rate.  The
+    rate register is only written when the rate actually changes.
+
+    """
+
+    def __init__(self, accelerometer, rest_rate = BW_RATE_12_5HZ,
+                 active_rate = BW_RATE_100HZ, threshold = 0.05, rest_after = 2.0):
+        self.accelerometer = accelerometer
+        self.rest_rate = rest_rate
+        self.active_rate = active_rate
+        self.threshold = threshold
+        self.rest_after = rest_after
+
+        self.active = True
+        self.rate = active_rate
+        self.last_motion = time()
+        self.last_axes = None
+        self.accelerometer.setBandwidthRate(self.rate)
+
+    def update(self, axes, now = None):
+        """Check a new sample for motion and return True while active."""
+        if now is None:
+            now = time()
+
+        if self.last_axes is not None:
+            delta = max(abs(axes['x'] - self.last_axes['x']),
+                        abs(axes['y'] - self.last_axes['y']),
+                        abs(axes['z'] - self.last_axes['z']))
+            if delta > self.threshold:
+                self.last_motion = now
+        self.last_axes = axes
+
+        active = (now - self.last_motion) < self.rest_after
+        if active != self.active:
+            self.active = active
+            self.rate = self.active_rate if active else self.rest_rate
+            self.accelerometer.setBandwidthRate(self.rate)
+        return self.active
+
+class FakeSMBus:
+    """In-memory stand-in for smbus.SMBus, for running the driver off the Pi.
+
+    Every device address gets its own 64 byte register file.  Writes are
+    recorded in order in self.writes as (address, register, value).  Set
+    registers directly through set_register() to fake what the chip reports.
+
+    """
+
+    def __init__(self):
+        self.registers = {}
+        self.writes = []
+
+    def _registers_for(self, address):
+        if address not in self.registers:
+            self.registers[address] = [0] * 64
+        return self.registers[address]
+
+    def set_register(self, address, register, value):
+        self._registers_for(address)[register] = value & 0xFF
+
+    def read_byte_data(self, address, register):
+        return self._registers_for(address)[register]
+
+    def write_byte_data(self, address, register, value):
+        self.writes.append((address, register, value))
+        self._registers_for(address)[register] = value & 0xFF
+
+    def read_i2c_block_data(self, address, register, length):
+        return list(self._registers_for(address)[register:register + length])
+
 if __name__ == "__main__":
     # if run directly we'll just create an instance of the class and output 
     # the current readings
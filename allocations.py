@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""Count the memory allocations made while rendering each frame.
+
+Every list, tuple or string made per frame is work for the allocator and,
+for containers, pushes the garbage collector closer to a collection pass,
+which shows up as a stutter in the animation.  AllocationCounter measures
+this so that a render path can be checked against a target of zero.
+
+With tracemalloc (Python 3.4+, or Python 2.7 patched for the pytracemalloc
+backport) each frame reports the memory blocks it allocated and still held
+at the end of the frame, and the peak number of bytes it had allocated at
+any point, which is where short lived temporaries show up.  Without it, as
+on a stock Python 2.7, the counter falls back to the garbage collector's own
+count of container objects: the net number made per frame.  That misses
+temporaries made and freed within the frame, but it is the very count that
+decides when a collection runs, so it still shows which frames lead to
+collection pauses.  Either way, it reports how many collections ran during
+frames.
+
+Recommended use:
+
+    import allocations
+
+    counter = allocations.AllocationCounter(report_every=60)
+
+    while True:
+        counter.start()
+        render_frame()
+        counter.stop()      # prints a summary every 60 frames
+
+"""
+
+from __future__ import division
+import gc
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class AllocationCounter(object):
+
+    def __init__(self, report_every=60, output=sys.stdout):
+        """Start counting.
+
+        report_every: frames to average over between printed reports; 0 to
+            never print and only keep the totals.
+        output: file to print reports to.
+
+        """
+        self.report_every = report_every
+        self.output = output
+        self.use_tracemalloc = tracemalloc is not None
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.blocks = 0
+        self.peak = 0
+        self.collections = 0
+        self._gc_count = (0, 0, 0)
+
+    def start(self):
+        """Mark the start of a frame."""
+        self._gc_count = gc.get_count()
+        if self.use_tracemalloc:
+            # forget everything allocated so far (the counter's own tuple
+            # included), so only this frame is traced
+            tracemalloc.clear_traces()
+
+    def stop(self):
+        """Mark the end of a frame, printing a report if one is due."""
+        if self.use_tracemalloc:
+            # read before anything else is made, so the counter's own objects
+            # aren't counted
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            self.blocks += len(tracemalloc.take_snapshot().traces)
+        count = gc.get_count()
+        # each youngest generation collection bumps the next generation's
+        # count (unless that was collected too, resetting it)
+        if count[1] != self._gc_count[1] or count[2] != self._gc_count[2]:
+            self.collections += 1
+        elif not self.use_tracemalloc:
+            self.blocks += count[0] - self._gc_count[0]
+        self.frames += 1
+
+        if self.report_every and self.frames >= self.report_every:
+            self.output.write('    %s\n' % self.report())
+            self.reset()
+
+    def report(self):
+        """Return a one line summary of the frames counted since the last reset."""
+        frames = self.frames or 1
+        if self.use_tracemalloc:
+            return 'allocations: %.1f blocks held, %d bytes peak per frame, %d collections' % (
+                self.blocks / frames, self.peak, self.collections)
+        return 'allocations: %.1f net gc-tracked objects per frame, %d collections' % (
+            self.blocks / frames, self.collections)
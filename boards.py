@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Where each Fadecandy board sits on the pixel grid and how it is wired.
+
+A board is described by a dict with these keys, all optional:
+
+    x, y            the grid column and row of the board's top left corner
+    width, height   the board's own size in LEDs, as wired: LED 0 first,
+                    along a row of width LEDs, then the next row
+    rotation        0, 90, 180 or 270 degrees clockwise; at 90 and 270 the
+                    block covered on the grid is height wide and width tall
+    flip_x, flip_y  mirror the board along its rows / columns
+    serpentine      every other row is wired back the other way
+    channel         OPC channel the board listens on when sent per board
+
+A boards file is a JSON list of these, in the order the boards are wired.
+Sloshbox maps its grid onto the boards with board_cells(), and preview.py
+uses the same function to draw frames the way Sloshbox sent them.
+
+Recommended use:
+
+    import boards
+
+    specs = boards.load_boards('layouts/boards8x8x2.json')
+    width, height = boards.grid_size(specs)
+    for spec in specs:
+        cells = boards.board_cells(spec)    # grid (row, col) per LED
+
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+DEFAULTS = {'x': 0, 'y': 0, 'width': 8, 'height': 8, 'rotation': 0,
+            'flip_x': False, 'flip_y': False, 'serpentine': False, 'channel': None}
+
+# two 8x8 boards side by side
+DEFAULT_BOARDS = [dict(DEFAULTS, x=0), dict(DEFAULTS, x=8)]
+
+def board_spec(item):
+    """Return a board dict with every key filled in, raising ValueError if
+    it can't describe a board."""
+    unknown = set(item) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('unknown board keys: %s' % ', '.join(sorted(unknown)))
+    spec = dict(DEFAULTS)
+    spec.update(item)
+    if spec['x'] < 0 or spec['y'] < 0:
+        raise ValueError('board position must not be negative, not (%r, %r)' % (spec['x'], spec['y']))
+    if spec['width'] < 1 or spec['height'] < 1:
+        raise ValueError('board size must be at least 1x1, not %rx%r' % (spec['width'], spec['height']))
+    spec['rotation'] %= 360
+    if spec['rotation'] not in (0, 90, 180, 270):
+        raise ValueError('board rotation must be 0, 90, 180 or 270, not %r' % item['rotation'])
+    return spec
+
+def load_boards(filename):
+    """Return the boards in a boards file as a list of board dicts."""
+    with open(filename) as f:
+        items = json.load(f)
+    specs = []
+    for ii, item in enumerate(items):
+        try:
+            specs.append(board_spec(item))
+        except ValueError as e:
+            raise ValueError('board %d in %s: %s' % (ii, filename, e))
+    return specs
+
+def board_cells(spec):
+    """Return the grid (row, col) each LED on a board lights, in wiring order."""
+    w = spec['width']
+    h = spec['height']
+    rotation = spec['rotation']
+    cells = []
+    for led in range(w * h):
+        row = led // w
+        col = led % w
+        if spec['serpentine'] and row % 2 == 1:
+            col = w - 1 - col
+        if spec['flip_x']:
+            col = w - 1 - col
+        if spec['flip_y']:
+            row = h - 1 - row
+
+        # rotate clockwise about the board's corner
+        if rotation == 0:
+            dx, dy = col, row
+        elif rotation == 90:
+            dx, dy = h - 1 - row, col
+        elif rotation == 180:
+            dx, dy = w - 1 - col, h - 1 - row
+        else:
+            dx, dy = row, w - 1 - col
+        cells.append((spec['y'] + dy, spec['x'] + dx))
+    return cells
+
+def grid_size(specs):
+    """Return the (width, height) of the smallest grid covering every board."""
+    width = height = 0
+    for spec in specs:
+        if spec['rotation'] in (90, 270):
+            across, down = spec['height'], spec['width']
+        else:
+            across, down = spec['width'], spec['height']
+        width = max(width, spec['x'] + across)
+        height = max(height, spec['y'] + down)
+    return width, height
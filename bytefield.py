@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""A fixed-point normal field kept in a bytearray, for installs without NumPy.
+
+Sloshbox's normalArray is a list of lists of floats, so every drain and
+palette lookup is a Python-level loop over every cell.  ByteField keeps the
+same field as one row-major bytearray of levels, 0 (empty) to 255 (full), so
+each step of a frame is a single operation done in C:
+
+    drain       levels.translate() through a precomputed "minus amount" table
+    stamp       slice assignment: levels[r*w:(r+1)*w] for a row, levels[c::w]
+                for a column
+    wire order  one operator.itemgetter() gather from grid to board order
+    palette     one bytes.translate() per color channel, written into the
+                payload with extended slices (payload[0::3] for red, ...)
+
+Recommended use:
+
+    import bytefield
+
+    field = bytefield.ByteField(16, 8)
+    field.set_drain(0.1)
+    field.set_palette(convertNormalToPixel)
+    field.set_wire_order(wire_order)    # (row, col) or None per LED
+
+    while True:
+        field.stamp_row(3)
+        field.drain()
+        client.put_payload(field.render())
+
+"""
+
+from __future__ import division
+import operator
+
+FULL = 255
+
+def _table(values):
+    """Return a 256 byte translate table from 256 levels."""
+    return bytes(bytearray(values))
+
+class ByteField(object):
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.levels = bytearray(width * height)
+        self._empty = bytes(bytearray(width * height))
+        self._full_row = bytes(bytearray([FULL] * width))
+        self._full_column = bytes(bytearray([FULL] * height))
+        self._drain = _table(range(256))
+        self._channels = None
+        self._gather = None
+        self._white = []
+        self.dither = None
+        self.payload = None
+
+    def set_drain(self, amount):
+        """Set how much drain() takes off every cell, as a fraction of full."""
+        step = int(round(amount * FULL))
+        self._drain = _table([max(0, level - step) for level in range(256)])
+
+    def set_palette(self, color_of):
+        """Build the per-channel lookup tables from a function that takes a
+        normal in the range 0.0-1.0 and returns an (r, g, b) color."""
+        colors = [color_of(level / FULL) for level in range(256)]
+        self._channels = [_table([int(color[ii]) for color in colors]) for ii in range(3)]
+
+    def set_dither(self, dither):
+        """Color through a dither.TemporalDither instead of the palette
+        tables, or through the palette again if dither is None."""
+        self.dither = dither
+
+    def set_wire_order(self, order):
+        """Set which cell lights each LED, in the order the LEDs are wired.
+
+        order: (row, col) per LED, or None for an LED outside the grid, which
+            is always lit full.
+
+        """
+        indices = []
+        self._white = []
+        for ii, cell in enumerate(order):
+            if cell is None:
+                indices.append(0)
+                self._white.append(ii)
+            else:
+                indices.append(cell[0] * self.width + cell[1])
+        if len(indices) == 1:
+            # itemgetter with a single index returns the item, not a tuple
+            index = indices[0]
+            self._gather = lambda levels: (levels[index],)
+        else:
+            self._gather = operator.itemgetter(*indices)
+        self.payload = bytearray(len(indices) * 3)
+
+    def clear(self):
+        self.levels[:] = self._empty
+
+    def empty(self):
+        """True once every cell has drained to 0."""
+        return self.levels == self._empty
+
+    def stamp_row(self, row):
+        """Fill a whole row of the field."""
+        start = row * self.width
+        self.levels[start:start + self.width] = self._full_row
+
+    def stamp_column(self, col):
+        """Fill a whole column of the field."""
+        self.levels[col::self.width] = self._full_column
+
+    def stamp_points(self, points):
+        """Fill the cells at each (x, y) point, clamped to the field."""
+        for x, y in points:
+            x = int(max(0, min(x, self.width - 1)))
+            y = int(max(0, min(y, self.height - 1)))
+            self.levels[y * self.width + x] = FULL
+
+    def drain(self):
+        self.levels[:] = self.levels.translate(self._drain)
+
+    def render(self):
+        """Return the payload of r, g, b bytes in wire order, rendered in place."""
+        wire = bytearray(self._gather(self.levels))
+        for ii in self._white:
+            wire[ii] = FULL
+        payload = self.payload
+        if self.dither is not None:
+            return self.dither.render(wire, payload)
+        for ii in range(3):
+            payload[ii::3] = wire.translate(self._channels[ii])
+        return payload
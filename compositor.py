@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""Layer several effects into one frame.
+
+Each Layer renders a whole frame of packed r, g, b bytes (a bytearray, one
+3 byte pixel per LED in wiring order), and the Compositor blends the layers
+over each other in order, starting from black.  Blending works on whole
+frames at once with C-level operations (map() over the two frames through
+max, operator.add or operator.mul, and bytes.translate() for opacity), with
+every table precomputed, so no Python code runs per pixel.
+
+Blend modes:
+
+    add         the layer is added on top, saturating at full brightness
+    max         each channel takes the brighter of the two
+    alpha       the layer is drawn over what is below
+    multiply    what is below is darkened by the layer
+
+A layer's opacity (0.0-1.0) fades it: an added layer is scaled down, and
+the others are mixed with what is below.  A disabled layer is skipped.
+
+Recommended use:
+
+    import compositor
+
+    frames = compositor.Compositor(n_pixels)
+    frames.add(compositor.Layer(waves, 'max'))
+    frames.add(compositor.Layer(sparkle, 'add', opacity=0.25))
+
+    while True:
+        client.put_payload(frames.render(t))
+
+"""
+
+from __future__ import division
+import operator
+
+BLEND_MODES = ('add', 'max', 'alpha', 'multiply')
+
+# results of adding or multiplying two channel values, brought back to 0-255
+SATURATE = [min(ii, 255) for ii in range(511)]
+DIVIDE = [(ii + 127) // 255 for ii in range(255 * 255 + 1)]
+
+def scale_table(factor):
+    """Return a translate table multiplying each byte by factor (0.0-1.0)."""
+    return bytes(bytearray([int(ii * factor + 0.5) for ii in range(256)]))
+
+def blend_add(below, above):
+    return bytearray(map(SATURATE.__getitem__, map(operator.add, below, above)))
+
+def blend_max(below, above):
+    return bytearray(map(max, below, above))
+
+def blend_multiply(below, above):
+    return bytearray(map(DIVIDE.__getitem__, map(operator.mul, below, above)))
+
+class Layer(object):
+    """One effect in a Compositor.
+
+    render: a function taking the time in seconds and returning a frame of
+        packed r, g, b bytes, as long as the frame it is drawn over.
+    blend: one of BLEND_MODES.
+    opacity: 0.0 (invisible) to 1.0.
+    enabled: whether the layer is drawn at all.
+
+    """
+
+    def __init__(self, render, blend='max', opacity=1.0, enabled=True, name=None):
+        if blend not in BLEND_MODES:
+            raise ValueError('unknown blend mode %r, expected one of %s' % (blend, ', '.join(BLEND_MODES)))
+        self.render = render
+        self.blend = blend
+        self.enabled = enabled
+        self.name = name or getattr(render, '__name__', 'layer')
+        self.set_opacity(opacity)
+
+    def set_opacity(self, opacity):
+        """Set the opacity, rebuilding its translate tables."""
+        self.opacity = max(0.0, min(1.0, opacity))
+        self._above = scale_table(self.opacity)
+        self._below = scale_table(1.0 - self.opacity)
+
+    def draw(self, below, t):
+        """Return the frame below with this layer blended over it, raising
+        ValueError if the layer renders a frame of a different length."""
+        above = self.render(t)
+        if len(above) != len(below):
+            # map() would pad the shorter frame with None on Python 2
+            raise ValueError('layer %r rendered %d bytes, expected %d' % (self.name, len(above), len(below)))
+        opaque = self.opacity >= 1.0
+        if self.blend == 'add':
+            return blend_add(below, above if opaque else above.translate(self._above))
+
+        if self.blend == 'max':
+            result = blend_max(below, above)
+        elif self.blend == 'multiply':
+            result = blend_multiply(below, above)
+        else:
+            result = above
+        if opaque:
+            return bytearray(result)
+        # mix with what was below; the two parts never sum past 255 by more
+        # than rounding
+        return blend_add(below.translate(self._below), result.translate(self._above))
+
+class Compositor(object):
+    """Blends a stack of Layers, bottom first, into one frame."""
+
+    def __init__(self, n_pixels):
+        self.n_pixels = n_pixels
+        self.layers = []
+        self._black = bytearray(n_pixels * 3)
+
+    def add(self, layer):
+        self.layers.append(layer)
+        return layer
+
+    def active(self):
+        """Return the layers that will be drawn."""
+        return [layer for layer in self.layers if layer.enabled and layer.opacity > 0]
+
+    def render(self, t):
+        """Return the blended frame for time t as a new bytearray."""
+        frame = self._black
+        for layer in self.active():
+            frame = layer.draw(frame, t)
+        if frame is self._black:
+            frame = bytearray(self._black)
+        return frame
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""Temporal dithering between palette colors.
+
+Sloshbox's palette only has a handful of colors, so a draining cell steps
+from one to the next.  A TemporalDither shows a cell whose normal falls
+between two palette stops as a mix of both over a short cycle of frames
+(phases), in proportion to how far it is between them, which the eye
+averages into the in-between shade.
+
+Everything is decided up front: for each phase there is a table from level
+(0-255) to color, so rendering a dithered frame costs a table lookup per
+pixel, or one bytes.translate() per phase and color channel for a whole
+bytearray of levels.  Neighbouring pixels are a phase apart, so the field
+shimmers a little rather than flashing as a whole.
+
+Recommended use:
+
+    import dither
+
+    ditherer = dither.TemporalDither([(0.0, black), (0.5, blue), (1.0, white)])
+
+    while True:
+        ditherer.render(levels, payload)    # one level per pixel, 0-255
+        client.put_payload(payload)
+        ditherer.advance()
+
+"""
+
+from __future__ import division
+
+def phase_thresholds(phases):
+    """Return one threshold per phase, evenly spaced over 0-1 but ordered so
+    that consecutive phases are far apart (bit reversed order), so a duty of
+    k/phases is spread through the cycle rather than bunched at its start."""
+    def reversed_bits(n):
+        value, scale = 0.0, 0.5
+        while n:
+            if n & 1:
+                value += scale
+            n >>= 1
+            scale /= 2
+        return value
+    order = sorted(range(phases), key=reversed_bits)
+    thresholds = [0.0] * phases
+    for rank, phase in enumerate(order):
+        thresholds[phase] = (rank + 0.5) / phases
+    return thresholds
+
+class TemporalDither(object):
+
+    def __init__(self, stops, phases=4):
+        """Build the dither tables.
+
+        stops: (normal, (r, g, b)) pairs in increasing order of normal, the
+            first at 0.0 and the last at 1.0.  Normals between two stops are
+            dithered between their colors.
+        phases: frames in one dither cycle; more phases means finer steps
+            between colors but a slower cycle.
+
+        """
+        self.phases = max(1, phases)
+        self.frame = 0
+        self.colors = [tuple(int(c) for c in color) for normal, color in stops]
+        normals = [normal for normal, color in stops]
+        thresholds = phase_thresholds(self.phases)
+
+        # stop index for each phase and level
+        self.indices = []
+        for threshold in thresholds:
+            table = []
+            for level in range(256):
+                normal = level / 255
+                ii = 0
+                while ii < len(normals) - 2 and normal >= normals[ii + 1]:
+                    ii += 1
+                span = normals[ii + 1] - normals[ii]
+                fraction = (normal - normals[ii]) / span if span else 1.0
+                table.append(ii + 1 if fraction > threshold else ii)
+            self.indices.append(table)
+
+        # packed r, g, b bytes, and a translate table per color channel
+        packed = [bytes(bytearray(color)) for color in self.colors]
+        self.rgb = [[packed[ii] for ii in table] for table in self.indices]
+        self.channels = [[bytes(bytearray([self.colors[ii][channel] for ii in table]))
+                          for channel in range(3)]
+                         for table in self.indices]
+
+    def advance(self):
+        """Move on to the next frame of the cycle."""
+        self.frame = (self.frame + 1) % self.phases
+
+    def color(self, level, ii=0):
+        """Return the (r, g, b) color for pixel ii at a level this frame."""
+        return self.colors[self.indices[(self.frame + ii) % self.phases][level]]
+
+    def color_bytes(self, level, ii=0):
+        """Return the packed r, g, b bytes for pixel ii at a level this frame."""
+        return self.rgb[(self.frame + ii) % self.phases][level]
+
+    def render(self, levels, payload, start=0):
+        """Write the colors for a bytearray of levels, one per pixel, into
+        payload as r, g, b bytes from byte start on, and return payload."""
+        phases = self.phases
+        end = start + len(levels) * 3
+        for offset in range(phases):
+            group = levels[offset::phases]
+            channels = self.channels[(self.frame + offset) % phases]
+            for channel in range(3):
+                payload[start + offset * 3 + channel:end:3 * phases] = group.translate(channels[channel])
+        return payload
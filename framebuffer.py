@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""A double-buffered frame area in shared memory.
+
+Lets other processes on the same host hand frames to Sloshbox (or anything
+else) without going through a socket.  The area is a memory-mapped file,
+normally on /dev/shm, holding a small header and two frame slots of packed
+r, g, b bytes.
+
+A writer fills the slot that isn't being shown and then bumps the sequence
+counter in the header, which flips the slots.  A reader copies the current
+slot and checks the counter didn't move while it was copying, retrying if it
+did, so it never sees a half written frame and neither side ever waits for
+the other.
+
+Recommended use:
+
+    import framebuffer
+
+    # in Sloshbox (or another consumer)
+    frames = framebuffer.SharedFrameBuffer('/dev/shm/sloshbox', n_pixels, create=True)
+    seq, pixels = frames.read()
+
+    # in an effect process
+    frames = framebuffer.SharedFrameBuffer('/dev/shm/sloshbox', n_pixels)
+    frames.write(my_rgb_bytes)
+
+"""
+
+from __future__ import division
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'SLFB'
+VERSION = 1
+
+# magic, version, frame size in bytes, sequence counter
+HEADER = struct.Struct('<4sHxxII')
+SEQ_OFFSET = 12
+
+class SharedFrameBuffer(object):
+
+    def __init__(self, path, n_pixels, create=False):
+        """Open (or with create=True, create) a shared frame area.
+
+        path: the file backing the area, e.g. '/dev/shm/sloshbox'.
+        n_pixels: pixels per frame; both sides must agree.
+
+        Raises ValueError if an existing area doesn't match n_pixels.
+
+        """
+        self.path = path
+        self.frame_size = n_pixels * 3
+        size = HEADER.size + 2 * self.frame_size
+
+        if create:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+            os.ftruncate(fd, size)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        try:
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        if create:
+            self._map[:HEADER.size] = HEADER.pack(MAGIC, VERSION, self.frame_size, 0)
+        else:
+            magic, version, frame_size, seq = HEADER.unpack(self._map[:HEADER.size])
+            if magic != MAGIC or version != VERSION or frame_size != self.frame_size:
+                raise ValueError('%s is not a %d pixel frame buffer' % (path, n_pixels))
+
+    def _slot(self, seq):
+        start = HEADER.size + (seq & 1) * self.frame_size
+        return start, start + self.frame_size
+
+    @property
+    def seq(self):
+        """The sequence number of the current frame; 0 until the first write."""
+        return struct.unpack('<I', self._map[SEQ_OFFSET:SEQ_OFFSET + 4])[0]
+
+    def write(self, pixels):
+        """Publish a frame of packed r, g, b bytes and return its sequence number."""
+        if len(pixels) != self.frame_size:
+            raise ValueError('frame is %d bytes, expected %d' % (len(pixels), self.frame_size))
+        seq = (self.seq + 1) & 0xFFFFFFFF
+        start, end = self._slot(seq)
+        self._map[start:end] = bytes(pixels)
+        self._map[SEQ_OFFSET:SEQ_OFFSET + 4] = struct.pack('<I', seq)
+        return seq
+
+    def read(self, retries=3):
+        """Return (seq, pixels) for the current frame.
+
+        pixels is a bytearray copy of the frame.  seq is 0 if nothing has been
+        written yet, in which case the pixels are all black.  Returns
+        (None, None) if the writer kept flipping the slots for every retry.
+
+        """
+        for attempt in range(retries):
+            seq = self.seq
+            start, end = self._slot(seq)
+            pixels = bytearray(self._map[start:end])
+            if self.seq == seq:
+                return seq, pixels
+        return None, None
+
+    def close(self):
+        self._map.close()
+
+class SharedFrameReader(object):
+    """Reads a SharedFrameBuffer and tracks whether its producer is still alive.
+
+    latest() returns the current frame only while the sequence counter keeps
+    moving; once it has stood still for timeout seconds the producer is
+    assumed gone and None is returned, so a crashed effect doesn't freeze
+    its last frame on the LEDs.
+
+    """
+
+    def __init__(self, frames, timeout=1.0):
+        self.frames = frames
+        self.timeout = timeout
+        self._seq = 0
+        self._changed_at = 0
+        self._pixels = None
+
+    def latest(self):
+        seq = self.frames.seq
+        if seq != self._seq:
+            read_seq, pixels = self.frames.read()
+            if read_seq is not None:
+                self._seq = read_seq
+                self._pixels = pixels
+                self._changed_at = time.time()
+        if not self._seq or time.time() - self._changed_at > self.timeout:
+            return None
+        return self._pixels
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    # test pattern producer: python framebuffer.py /dev/shm/sloshbox 128
+    path = sys.argv[1] if len(sys.argv) > 1 else '/dev/shm/sloshbox'
+    n_pixels = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+    frames = SharedFrameBuffer(path, n_pixels)
+    print('    writing a moving dot to %s (control-c to exit)' % path)
+    ii = 0
+    while True:
+        pixels = bytearray(n_pixels * 3)
+        pixels[(ii % n_pixels) * 3:(ii % n_pixels) * 3 + 3] = b'\xff\x00\x00'
+        frames.write(pixels)
+        ii += 1
+        time.sleep(1 / 30)
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+"""Loading layout files and mapping their points onto the simulation grid.
+
+A layout file is a JSON list of {"point": [x, y, z]} entries, one per LED in
+the order they are wired.  Rather than assuming the LEDs form a neat grid,
+SamplingTable works out, once at load time, where each point falls on the
+simulation grid and which grid cells to blend to light it.  After that every
+frame is a single gather and weighted sum, however the LEDs are arranged.
+
+Layouts are parsed as a stream, one point at a time, into a flat coordinate
+array (see load_layout()), so even huge generated layouts don't need the
+whole JSON object graph in memory.
+
+Recommended use:
+
+    import layout
+
+    coordinates = layout.load_layout('layouts/fadecandy8x8x2.json')
+    table = layout.SamplingTable(coordinates, grid_width, grid_height)
+
+    while True:
+        field = [value for row in normalArray for value in row]
+        normals = table.sample(field)   # one value per LED, in wiring order
+
+Parsing a big layout's JSON is slow, so load_compiled() keeps the parsed
+points and sampling table in a binary cache file next to the layout, keyed by
+a hash of the JSON, and only parses the JSON again when it changes.
+
+"""
+
+from __future__ import division
+import array
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class PointArray(object):
+    """A read-only sequence of (x, y, z) points stored in one flat array('d').
+
+    Behaves like a list of 3-tuples, but takes 24 bytes per point instead of
+    a tuple and three float objects.
+
+    """
+
+    def __init__(self, flat):
+        self.flat = flat
+
+    def __len__(self):
+        return len(self.flat) // 3
+
+    def __getitem__(self, ii):
+        if ii < 0:
+            ii += len(self)
+        if not 0 <= ii < len(self):
+            raise IndexError('point index out of range')
+        return tuple(self.flat[ii * 3:ii * 3 + 3])
+
+    def __iter__(self):
+        flat = self.flat
+        for ii in range(0, len(flat), 3):
+            yield tuple(flat[ii:ii + 3])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+def iter_items(f, chunk_size=65536):
+    """Yield the items of the top-level JSON list in file f one at a time.
+
+    Only chunk_size bytes plus the item being decoded are held in memory at
+    once, however long the list is.  Raises ValueError if the file isn't a
+    JSON list.
+
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    eof = not buf
+    pos = 0
+    in_list = False
+    while True:
+        # skip whitespace and commas, reading more as needed
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf = f.read(chunk_size)
+            eof = not buf
+            pos = 0
+
+        if pos >= len(buf):
+            raise ValueError('layout list is not closed')
+        if not in_list:
+            if buf[pos] != '[':
+                raise ValueError('layout must be a JSON list')
+            in_list = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+
+        try:
+            # layout items are objects, so a successful decode is never of a
+            # truncated item
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            # the item runs past the end of the buffer; read more of it
+            more = f.read(chunk_size)
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+
+        yield item
+        pos = end
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+def count_points(filename, chunk_size=65536):
+    """Return an upper bound on the number of points in a layout file, by
+    counting "point" keys a chunk at a time."""
+    key = '"point"'
+    count = 0
+    tail = ''
+    with open(filename) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return count
+            text = tail + chunk
+            count += text.count(key)
+            # keep enough to catch a key split across chunks, but not enough
+            # to count a whole one twice
+            tail = text[-(len(key) - 1):]
+
+def load_layout(filename, chunk_size=65536):
+    """Return the points in a layout file as a PointArray of (x, y, z).
+
+    The file is streamed: points are decoded one at a time into a coordinate
+    array sized up front, so memory use stays proportional to the number of
+    points rather than to the size of the JSON.  Raises ValueError if a point
+    isn't a list of exactly 3 numbers.
+
+    """
+    flat = array.array('d', [0.0]) * (3 * count_points(filename, chunk_size))
+    ii = 0
+    with open(filename) as f:
+        for item in iter_items(f, chunk_size):
+            if 'point' in item:
+                point = item['point']
+                # a short point would shift every point after it
+                if not isinstance(point, list) or len(point) != 3:
+                    raise ValueError('point %d in %s is %r, not [x, y, z]' % (ii // 3, filename, point))
+                flat[ii:ii + 3] = array.array('d', point)
+                ii += 3
+    del flat[ii:]
+    return PointArray(flat)
+
+def widest_axes(coordinates):
+    """Return the two axes (0=x, 1=y, 2=z) along which the points spread
+    furthest, in x, y, z order.
+    """
+    spreads = []
+    for axis in range(3):
+        values = [point[axis] for point in coordinates]
+        spreads.append((max(values) - min(values), axis))
+    return tuple(sorted([axis for spread, axis in sorted(spreads, reverse=True)[:2]]))
+
+class SamplingTable(object):
+    """Bilinear sampling weights from a grid_width x grid_height field to
+    each layout point.
+
+    The layout's bounding box along the `across` and `down` axes (by default
+    its two widest axes) is stretched over the grid, so the outermost points
+    land on the outermost cells.  Each point then blends the 4 cells around
+    it.  The grid is regular, so finding those cells is a direct hash of the
+    point's position rather than a search.
+
+    With nearest=True each point takes the value of the single closest cell
+    instead (its other 3 taps get no weight), for blocky rather than smooth
+    scaling.
+
+    The table is kept as two flat arrays, `indices` and `weights`, with 4
+    entries per point; indices are into the row-major flattened field.
+
+    """
+
+    TAPS = 4
+
+    def __init__(self, coordinates, grid_width, grid_height, across=None, down=None, nearest=False):
+        if across is None or down is None:
+            across, down = widest_axes(coordinates)
+        self.grid_width = grid_width
+        self.grid_height = grid_height
+        self.n_points = len(coordinates)
+        self.indices = array.array('i')
+        self.weights = array.array('f')
+
+        u_values = [point[across] for point in coordinates]
+        v_values = [point[down] for point in coordinates]
+        u_min, u_span = min(u_values), (max(u_values) - min(u_values)) or 1.0
+        v_min, v_span = min(v_values), (max(v_values) - min(v_values)) or 1.0
+
+        for u, v in zip(u_values, v_values):
+            # position on the grid, in cells
+            gx = (u - u_min) / u_span * (grid_width - 1)
+            gy = (v - v_min) / v_span * (grid_height - 1)
+            if nearest:
+                self._add_nearest(gx, gy)
+            else:
+                self._add_bilinear(gx, gy)
+
+        self._numpy_tables = None
+
+    @classmethod
+    def from_arrays(cls, grid_width, grid_height, indices, weights):
+        """Make a table from already computed index and weight arrays."""
+        table = cls.__new__(cls)
+        table.grid_width = grid_width
+        table.grid_height = grid_height
+        table.n_points = len(indices) // cls.TAPS
+        table.indices = indices
+        table.weights = weights
+        table._numpy_tables = None
+        return table
+
+    def _add_bilinear(self, gx, gy):
+        x0 = int(math.floor(gx))
+        y0 = int(math.floor(gy))
+        x0 = max(0, min(x0, self.grid_width - 1))
+        y0 = max(0, min(y0, self.grid_height - 1))
+        x1 = min(x0 + 1, self.grid_width - 1)
+        y1 = min(y0 + 1, self.grid_height - 1)
+        fx = max(0.0, min(gx - x0, 1.0))
+        fy = max(0.0, min(gy - y0, 1.0))
+        # a point on a cell should read exactly that cell, not pick up float
+        # noise from its neighbours (a full cell must still sample as 1.0)
+        fx = round(fx, 6)
+        fy = round(fy, 6)
+
+        w = self.grid_width
+        self.indices.extend([y0 * w + x0, y0 * w + x1, y1 * w + x0, y1 * w + x1])
+        self.weights.extend([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy])
+
+    def _add_nearest(self, gx, gy):
+        x = max(0, min(int(math.floor(gx + 0.5)), self.grid_width - 1))
+        y = max(0, min(int(math.floor(gy + 0.5)), self.grid_height - 1))
+        index = y * self.grid_width + x
+        self.indices.extend([index] * self.TAPS)
+        self.weights.extend([1.0, 0.0, 0.0, 0.0])
+
+    def sample(self, field, out=None):
+        """Return the value of the field at every layout point.
+
+        field: the grid as a flat row-major sequence of grid_width *
+            grid_height values (or a NumPy array, for the vectorized path).
+        out: optional list of n_points values to fill in place.
+
+        """
+        if numpy is not None and isinstance(field, numpy.ndarray):
+            if self._numpy_tables is None:
+                self._numpy_tables = (
+                    numpy.frombuffer(self.indices, dtype=numpy.int32).reshape(-1, self.TAPS),
+                    numpy.frombuffer(self.weights, dtype=numpy.float32).reshape(-1, self.TAPS))
+            indices, weights = self._numpy_tables
+            return (field.ravel()[indices] * weights).sum(axis=1)
+
+        if out is None:
+            out = [0.0] * self.n_points
+        indices = self.indices
+        weights = self.weights
+        for ii in range(self.n_points):
+            jj = ii * 4
+            out[ii] = (field[indices[jj]] * weights[jj] +
+                       field[indices[jj + 1]] * weights[jj + 1] +
+                       field[indices[jj + 2]] * weights[jj + 2] +
+                       field[indices[jj + 3]] * weights[jj + 3])
+        return out
+
+#-------------------------------------------------------------------------------
+# compiled layout cache
+
+# magic, version, byte order, sha1 of the layout JSON, points, grid width, height
+CACHE_HEADER = struct.Struct('<4sHBx20sIII')
+CACHE_MAGIC = b'SLLC'
+CACHE_VERSION = 2
+CACHE_BYTEORDER = 0 if sys.byteorder == 'little' else 1
+
+def _array_from(typecode, data, start, end):
+    """Return an array of data[start:end], copied once, without slicing data."""
+    values = array.array(typecode)
+    if hasattr(values, 'frombytes'):
+        view = memoryview(data)
+        try:
+            values.frombytes(view[start:end])
+        finally:
+            view.release()
+    else:
+        values.fromstring(buffer(data, start, end - start))
+    return values
+
+def _array_bytes(values):
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+def layout_hash(filename, chunk_size=65536):
+    """Return the sha1 digest of a layout file's contents, reading it
+    chunk_size bytes at a time."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return digest.digest()
+            digest.update(chunk)
+
+def cache_filename(filename):
+    return filename + '.cache'
+
+def compile_layout(filename, grid_width=None, grid_height=None, digest=None):
+    """Parse a layout (and build its SamplingTable, if a grid size is given)
+    and write both to its cache file.
+
+    Returns (coordinates, table or None).  A cache that can't be written is
+    not an error; the layout just gets parsed again next time.
+
+    """
+    if digest is None:
+        digest = layout_hash(filename)
+    coordinates = load_layout(filename)
+    table = None
+    if grid_width and grid_height:
+        table = SamplingTable(coordinates, grid_width, grid_height)
+
+    flat = coordinates.flat
+    pieces = [CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, CACHE_BYTEORDER, digest,
+                                len(coordinates), grid_width or 0, grid_height or 0),
+              _array_bytes(flat)]
+    if table:
+        pieces.append(_array_bytes(table.indices))
+        pieces.append(_array_bytes(table.weights))
+
+    # write and rename, so a reader never sees half a cache
+    path = cache_filename(filename)
+    temporary = '%s.%d' % (path, os.getpid())
+    try:
+        with open(temporary, 'wb') as f:
+            for piece in pieces:
+                f.write(piece)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        pass
+    finally:
+        # only still there if the write or rename failed
+        if os.path.exists(temporary):
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+    return coordinates, table
+
+def load_compiled(filename, grid_width=None, grid_height=None):
+    """Return (coordinates, table) for a layout, from its cache when it is
+    up to date and by parsing the JSON (and rewriting the cache) when not.
+
+    table is a SamplingTable for the given grid size, or None if no grid size
+    is given.  The cache file is memory-mapped and its arrays are copied
+    straight out of the mapping, with no parsing and no intermediate string.
+    A cache that is stale, or of the wrong size for what its header says it
+    holds (e.g. truncated), is rebuilt.
+
+    """
+    digest = layout_hash(filename)
+    try:
+        with open(cache_filename(filename), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < CACHE_HEADER.size:
+                data = None
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, mmap.error):
+        # no cache yet
+        data = None
+    if data is None:
+        return compile_layout(filename, grid_width, grid_height, digest)
+
+    try:
+        magic, version, byteorder, cached_digest, n_points, width, height = \
+            CACHE_HEADER.unpack_from(data, 0)
+        if (magic != CACHE_MAGIC or version != CACHE_VERSION or byteorder != CACHE_BYTEORDER or
+                cached_digest != digest or width != (grid_width or 0) or height != (grid_height or 0)):
+            return compile_layout(filename, grid_width, grid_height, digest)
+
+        # 3 doubles per point, then 4 int indices and 4 float weights per point
+        taps = n_points * SamplingTable.TAPS if width and height else 0
+        if size != CACHE_HEADER.size + n_points * 3 * 8 + taps * 4 * 2:
+            return compile_layout(filename, grid_width, grid_height, digest)
+
+        offset = CACHE_HEADER.size
+        end = offset + n_points * 3 * 8
+        coordinates = PointArray(_array_from('d', data, offset, end))
+
+        table = None
+        if taps:
+            offset, end = end, end + taps * 4
+            indices = _array_from('i', data, offset, end)
+            offset, end = end, end + taps * 4
+            weights = _array_from('f', data, offset, end)
+            table = SamplingTable.from_arrays(width, height, indices, weights)
+        return coordinates, table
+    finally:
+        data.close()
@@ -31,10 +31,30 @@ Recommended use:
             print('not connected')
         time.sleep(1/30.0)
 
+To keep a down or slow server from ever stalling the caller, use
+BackgroundClient instead of Client.  It takes the same server string and
+sends from a worker thread, reconnecting in the background.
+
 """
 
+import collections
+import json
 import socket
 import struct
+import threading
+import time
+
+# OPC system exclusive messages
+SYSEX_COMMAND = 0xFF
+FADECANDY_SYSTEM_ID = 0x0001
+FADECANDY_COLOR_CORRECTION = 0x0001
+FADECANDY_FIRMWARE_CONFIG = 0x0002
+
+# Fadecandy firmware configuration bits
+FIRMWARE_NO_DITHERING = 0x01
+FIRMWARE_NO_INTERPOLATION = 0x02
+FIRMWARE_MANUAL_LED = 0x04
+FIRMWARE_LED_ON = 0x08
 
 class Client(object):
 
@@ -69,6 +89,15 @@ class Client(object):
 
         self._socket = None  # will be None when we're not connected
 
+        # last message sent on each channel by put_channels(), which only
+        # resends a channel when its pixels change or every refresh_period seconds
+        self.refresh_period = 1.0
+        self._sent_messages = {}
+        self._refreshed_at = 0
+
+        # SysEx configuration messages, sent again on every new connection
+        self._config_messages = collections.OrderedDict()
+
     def _debug(self, m):
         if self.verbose:
             print('    %s' % str(m))
@@ -88,6 +117,11 @@ class Client(object):
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._socket.connect((self._ip, self._port))
             self._debug('_ensure_connected:    ...success')
+            # a new connection may be a restarted server; resend every channel
+            # and the configuration
+            self._sent_messages = {}
+            if self._config_messages:
+                self._socket.sendall(''.join(self._config_messages.values()))
             return True
         except socket.error:
             self._debug('_ensure_connected:    ...failure')
@@ -138,13 +172,15 @@ class Client(object):
         LED at a time (unless it's the first one).
 
         """
-        self._debug('put_pixels: connecting')
-        is_connected = self._ensure_connected()
-        if not is_connected:
-            self._debug('put_pixels: not connected.  ignoring these pixels.')
-            return False
+        return self.put_message(self.build_message(pixels, channel))
+
+    def build_message(self, pixels, channel=0):
+        """Encode the list of pixel colors as a complete OPC message.
+
+        Takes the same arguments as put_pixels() and returns the message as a
+        string, ready for put_message().
 
-        # build OPC message
+        """
         len_hi_byte = int(len(pixels)*3 / 256)
         len_lo_byte = (len(pixels)*3) % 256
         header = chr(channel) + chr(0) + chr(len_hi_byte) + chr(len_lo_byte)
@@ -153,20 +189,628 @@ class Client(object):
                      min(255, max(0, int(g))),
                      min(255, max(0, int(b)))) for r, g, b in pixels ]
 
-        message = ''.join(pieces)
+        return ''.join(pieces)
+
+    def build_header(self, length, channel=0, command=0):
+        """Encode just the 4 byte header of an OPC message with a length byte payload."""
+        return struct.pack('>BBH', channel, command, length)
+
+    def put_payload(self, payload, channel=0):
+        """Send a buffer of raw r, g, b bytes to the OPC server on the given channel.
 
-        self._debug('put_pixels: sending pixels to server')
+        payload: a bytearray (or other buffer) of 3 bytes per pixel, already
+            clamped to 0-255.
+
+        The payload is never converted to a list of pixels; it is copied
+        once, behind the header, and sent in a single write.
+        Return True on success or False on failure, as for put_pixels().
+
+        """
+        return self.put_buffers([self.build_header(len(payload), channel), payload])
+
+    def put_buffers(self, buffers):
+        """Send a list of buffers which together make up OPC messages.
+
+        The buffers are joined and written with one sendall(); writing them
+        one at a time, even with the socket corked, measured 1.5-3x slower
+        for every message size OPC allows.
+
+        """
+        self._debug('put_buffers: connecting')
+        is_connected = self._ensure_connected()
+        if not is_connected:
+            self._debug('put_buffers: not connected.  ignoring this message.')
+            return False
+
+        self._debug('put_buffers: sending message to server')
         try:
-            self._socket.send(message)
+            self._send_buffers(buffers)
         except socket.error:
-            self._debug('put_pixels: connection lost.  could not send pixels.')
+            self._debug('put_buffers: connection lost.  could not send message.')
             self._socket = None
             return False
 
         if not self._long_connection:
-            self._debug('put_pixels: disconnecting')
+            self._debug('put_buffers: disconnecting')
             self.disconnect()
 
         return True
 
+    def _send_buffers(self, buffers):
+        # one copy and one write: for every size an OPC message can be this
+        # beats writing the buffers separately, corked or not
+        message = bytearray()
+        for buf in buffers:
+            message += buf
+        self._socket.sendall(message)
+
+    def put_message(self, message):
+        """Send an already encoded OPC message to the server.
+
+        Will establish a connection to the server as needed.  The whole
+        message is written, even if the socket only accepts part of it at a
+        time.
+
+        On successful transmission, return True.
+        On failure (bad connection), return False.
+
+        """
+        self._debug('put_message: connecting')
+        is_connected = self._ensure_connected()
+        if not is_connected:
+            self._debug('put_message: not connected.  ignoring this message.')
+            return False
+
+        self._debug('put_message: sending message to server')
+        try:
+            self._socket.sendall(message)
+        except socket.error:
+            self._debug('put_message: connection lost.  could not send message.')
+            self._socket = None
+            return False
+
+        if not self._long_connection:
+            self._debug('put_message: disconnecting')
+            self.disconnect()
+
+        return True
+
+    def put_channels(self, channel_pixels):
+        """Send pixels to several channels, skipping channels that haven't changed.
+
+        channel_pixels: a list of (channel, pixels) pairs, with pixels as for
+            put_pixels().
+
+        Only channels whose pixels differ from the last ones sent are
+        transmitted.  Every channel is sent again after a reconnection, after a
+        failed send and at least every refresh_period seconds, so a server that
+        missed an update catches up.
+
+        Return True on success (including when nothing needed sending) and
+        False on failure.
+
+        """
+        return self.put_channel_messages([(channel, self.build_message(pixels, channel))
+                                          for channel, pixels in channel_pixels])
+
+    def put_channel_messages(self, channel_messages):
+        """Like put_channels(), but with each channel's message already encoded.
+
+        channel_messages: a list of (channel, message) pairs, with messages as
+            made by build_message().
+
+        """
+        now = time.time()
+        if now - self._refreshed_at >= self.refresh_period:
+            self._sent_messages = {}
+            self._refreshed_at = now
+
+        changed = []
+        for channel, message in channel_messages:
+            if self._sent_messages.get(channel) != message:
+                changed.append((channel, message))
+
+        if not changed:
+            return True
+
+        if not self._put_messages([message for channel, message in changed]):
+            self._sent_messages = {}
+            return False
+
+        for channel, message in changed:
+            self._sent_messages[channel] = message
+        return True
+
+    def _put_messages(self, messages):
+        # OPC is a stream of messages, so several can go in one write
+        return self.put_message(''.join(messages))
+
+    def build_sysex(self, system_id, sysex_id, data, channel=0):
+        """Encode an OPC system exclusive (command 0xFF) message.
+
+        system_id: who the message is for, e.g. FADECANDY_SYSTEM_ID.
+        sysex_id: which of that system's messages this is.
+        data: the message body, as a string.
+
+        """
+        payload = struct.pack('>HH', system_id, sysex_id) + data
+        header = chr(channel) + chr(SYSEX_COMMAND) + struct.pack('>H', len(payload))
+        return header + payload
+
+    def set_color_correction(self, gamma=2.5, whitepoint=(1.0, 1.0, 1.0),
+                             linear_slope=1.0, linear_cutoff=0.0, channel=0):
+        """Have Fadecandy hardware apply gamma and white point correction.
+
+        gamma: exponent of the gamma curve applied to every channel.
+        whitepoint: (r, g, b) multipliers, 0-1, applied after the gamma curve.
+        linear_slope, linear_cutoff: below linear_cutoff the curve is a
+            straight line of slope linear_slope instead, for smoother fades
+            near black.
+
+        The pixels sent should then be linear, without gamma applied in
+        Python.  The setting is remembered and sent again on every new
+        connection.  Return True if it was sent.
+
+        """
+        data = json.dumps({
+            'gamma': gamma,
+            'whitepoint': list(whitepoint),
+            'linearSlope': linear_slope,
+            'linearCutoff': linear_cutoff,
+        })
+        message = self.build_sysex(FADECANDY_SYSTEM_ID, FADECANDY_COLOR_CORRECTION, data, channel)
+        return self._put_config(FADECANDY_COLOR_CORRECTION, message)
+
+    def set_firmware_config(self, dithering=True, interpolation=True,
+                            manual_led=False, led_on=False, channel=0):
+        """Set the Fadecandy firmware options.
+
+        dithering: temporal dithering, for smooth low-brightness fades.
+        interpolation: smooth between frames on the board, so frames can be
+            sent at a lower rate than the LEDs refresh.
+        manual_led, led_on: take over the board's status LED.
+
+        The setting is remembered and sent again on every new connection.
+        Return True if it was sent.
+
+        """
+        flags = 0
+        if not dithering:
+            flags |= FIRMWARE_NO_DITHERING
+        if not interpolation:
+            flags |= FIRMWARE_NO_INTERPOLATION
+        if manual_led:
+            flags |= FIRMWARE_MANUAL_LED
+        if led_on:
+            flags |= FIRMWARE_LED_ON
+        message = self.build_sysex(FADECANDY_SYSTEM_ID, FADECANDY_FIRMWARE_CONFIG, chr(flags), channel)
+        return self._put_config(FADECANDY_FIRMWARE_CONFIG, message)
+
+    def _put_config(self, key, message):
+        self._config_messages[key] = message
+        if self._socket:
+            return self.put_message(message)
+
+        # connecting sends every stored configuration message
+        success = self._ensure_connected()
+        if not self._long_connection:
+            self.disconnect()
+        return success
+
+
+class BackgroundClient(Client):
+
+    def __init__(self, server_ip_port, max_pending=1, backoff_min=0.1, backoff_max=5.0,
+                 timeout=1.0, verbose=False):
+        """Create an OPC client which connects and sends from a background thread.
+
+        put_pixels() and put_message() never block: they queue the message and
+        return immediately.  A worker thread keeps a long-lived connection to
+        the server, reconnecting with exponential backoff (from backoff_min up
+        to backoff_max seconds) while the server is down.
+
+        max_pending: how many messages may wait while the socket is busy.  When
+            the queue is full the oldest message is dropped, so a slow or
+            backpressured server only ever sees the latest frames.
+        timeout: seconds allowed for connecting and for writing one message
+            before the connection is considered lost.
+
+        Each message is always written in full.  Call close() to stop the
+        worker thread.
+
+        """
+        Client.__init__(self, server_ip_port, long_connection=True, verbose=verbose)
+        self._timeout = timeout
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+
+        self._pending = collections.deque(maxlen=max_pending)
+        self._condition = threading.Condition()
+        self._connected = threading.Event()
+        self._closed = False
+        self._config_dirty = False
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name='opc-%s:%d' % (self._ip, self._port))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        delay = self._backoff_min
+        while True:
+            with self._condition:
+                if self._closed:
+                    break
+                if self._socket is None:
+                    message = None
+                else:
+                    while not self._pending and not self._config_dirty and not self._closed:
+                        self._condition.wait()
+                    if self._closed:
+                        break
+                    if self._config_dirty:
+                        # configuration goes out before any more frames
+                        message = ''.join(self._config_messages.values())
+                        self._config_dirty = False
+                    else:
+                        message = self._pending.popleft()
+
+            if self._socket is None:
+                if self._connect():
+                    delay = self._backoff_min
+                else:
+                    self._debug('_run: retrying in %.1fs' % delay)
+                    with self._condition:
+                        if not self._closed:
+                            self._condition.wait(delay)
+                    delay = min(delay * 2, self._backoff_max)
+                continue
+
+            try:
+                self._socket.sendall(message)
+            except socket.error:
+                self._debug('_run: connection lost.  could not send message.')
+                self._drop_socket()
+
+        self._drop_socket()
+
+    def _connect(self):
+        try:
+            self._debug('_connect: trying to connect...')
+            self._socket = socket.create_connection((self._ip, self._port), self._timeout)
+            self._debug('_connect:    ...success')
+            self._sent_messages = {}
+            with self._condition:
+                self._config_dirty = bool(self._config_messages)
+            self._connected.set()
+            return True
+        except socket.error:
+            self._debug('_connect:    ...failure')
+            self._socket = None
+            return False
+
+    def _drop_socket(self):
+        self._connected.clear()
+        if self._socket:
+            self._socket.close()
+        self._socket = None
+
+    def can_connect(self, timeout=None):
+        """Wait up to timeout seconds (default: the client's timeout) for the
+        background connection.
 
+        Return True if connected or False if not (yet).
+
+        """
+        if timeout is None:
+            timeout = self._timeout
+        self._connected.wait(timeout)
+        return self._connected.is_set()
+
+    def put_buffers(self, buffers):
+        """Queue buffers for sending, without blocking.
+
+        The buffers are copied into one message first, since the caller is free
+        to reuse them as soon as this returns.
+
+        """
+        message = bytearray()
+        for buf in buffers:
+            message += buf
+        return self.put_message(bytes(message))
+
+    def _put_config(self, key, message):
+        # never dropped, unlike frames
+        with self._condition:
+            self._config_messages[key] = message
+            self._config_dirty = True
+            self._condition.notify()
+        return self._connected.is_set()
+
+    def disconnect(self):
+        """Drop the current connection; the worker will reconnect."""
+        self._debug('disconnecting')
+        with self._condition:
+            if self._socket:
+                try:
+                    self._socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def close(self):
+        """Stop the worker thread and drop the connection."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def put_message(self, message):
+        """Queue an already encoded OPC message for sending, without blocking.
+
+        Return True if currently connected, or False if the message is waiting
+        for the connection to come back.
+
+        """
+        with self._condition:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+                # whatever put_channels() thought was sent may have been dropped
+                self._sent_messages = {}
+            self._pending.append(message)
+            self._condition.notify()
+        return self._connected.is_set()
+
+
+class UDPClient(Client):
+
+    def __init__(self, server_ip_port, mtu=1500, verbose=False):
+        """Create an OPC client which sends each message as one UDP datagram.
+
+        Uses the same OPC message format as Client, but there is no connection
+        to set up or lose, and a frame that can't be sent right away is dropped
+        rather than delaying the frames after it.  This suits live frames on
+        lossy links such as Wi-Fi.
+
+        mtu: the link MTU.  A message must fit in a single unfragmented
+            datagram, so at most max_pixels pixels can go in one message;
+            longer frames are refused.  Split them across channels instead.
+
+        self.sent and self.dropped count datagrams sent and frames dropped.
+
+        """
+        Client.__init__(self, server_ip_port, long_connection=True, verbose=verbose)
+        self.max_message = self.max_message_for(mtu)
+        self.max_pixels = self.max_pixels_for(mtu)
+        self.sent = 0
+        self.dropped = 0
+
+    @staticmethod
+    def max_message_for(mtu=1500):
+        """Return the longest OPC message that fits in one datagram on a link."""
+        # 20 byte IPv4 header + 8 byte UDP header
+        return mtu - 28
+
+    @staticmethod
+    def max_pixels_for(mtu=1500):
+        """Return the most pixels one message can carry on a link."""
+        return (UDPClient.max_message_for(mtu) - 4) // 3
+
+    def _ensure_connected(self):
+        if self._socket:
+            return True
+
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+            self._socket.connect((self._ip, self._port))
+            return True
+        except socket.error:
+            self._debug('_ensure_connected: could not resolve the server')
+            self._socket = None
+            return False
+
+    def put_message(self, message):
+        """Send an already encoded OPC message as a single datagram.
+
+        Return True if it was handed to the network, or False if it was too
+        large or had to be dropped.
+
+        """
+        if len(message) > self.max_message:
+            self._debug('put_message: %d byte message does not fit in one datagram' % len(message))
+            self.dropped += 1
+            return False
+
+        if not self._ensure_connected():
+            self.dropped += 1
+            return False
+
+        try:
+            self._socket.send(message)
+        except socket.error:
+            # socket buffer full or the server isn't listening (yet)
+            self._debug('put_message: dropped a frame')
+            self.dropped += 1
+            return False
+
+        self.sent += 1
+        return True
+
+    def put_buffers(self, buffers):
+        """Send buffers which together make up one OPC message as a single datagram."""
+        length = sum([len(buf) for buf in buffers])
+        if length > self.max_message:
+            self._debug('put_buffers: %d byte message does not fit in one datagram' % length)
+            self.dropped += 1
+            return False
+
+        if not self._ensure_connected():
+            self.dropped += 1
+            return False
+
+        try:
+            self._send_buffers(buffers)
+        except socket.error:
+            self._debug('put_buffers: dropped a frame')
+            self.dropped += 1
+            return False
+
+        self.sent += 1
+        return True
+
+    def _put_config(self, key, message):
+        # no connection to resend it on; call again if it may have been lost
+        self._config_messages[key] = message
+        return self.put_message(message)
+
+    def _put_messages(self, messages):
+        # one message per datagram
+        success = True
+        for message in messages:
+            success = self.put_message(message) and success
+        return success
+
+
+class FanoutClient(object):
+
+    def __init__(self, targets, max_pending=1, verbose=False):
+        """Create an OPC client which sends every frame to several servers.
+
+        targets: a list of servers.  Each is either an ip:port string, which
+            gets every pixel, or an (ip:port, start, end) tuple, which gets
+            only pixels[start:end].  A string such as
+            'host1:7890,host2:7890@0:64' can be turned into this list with
+            parse_targets().
+
+        Every target gets its own BackgroundClient, so the connections are
+        kept open, sends to each target happen concurrently, and a slow or
+        missing target can't delay the others.  Each distinct slice of a
+        frame is encoded only once, however many targets it goes to.
+
+        """
+        self._targets = []
+        for target in targets:
+            if isinstance(target, tuple):
+                server_ip_port, start, end = target
+            else:
+                server_ip_port, start, end = target, None, None
+            client = BackgroundClient(server_ip_port, max_pending=max_pending, verbose=verbose)
+            self._targets.append((client, start, end))
+
+    @property
+    def clients(self):
+        return [client for client, start, end in self._targets]
+
+    def can_connect(self, timeout=1.0):
+        """Wait up to timeout seconds for every target to connect.
+
+        Return True if all of them are connected.
+
+        """
+        return all([client.can_connect(timeout) for client in self.clients])
+
+    def put_pixels(self, pixels, channel=0):
+        """Queue the pixels for every target, without blocking.
+
+        Takes the same arguments as Client.put_pixels().  Return True if every
+        target is currently connected.
+
+        """
+        messages = {}
+        success = True
+        for client, start, end in self._targets:
+            key = (start, end)
+            if key not in messages:
+                messages[key] = client.build_message(pixels[start:end], channel)
+            success = client.put_message(messages[key]) and success
+        return success
+
+    def put_channels(self, channel_pixels):
+        """Send only the changed channels to every target; see Client.put_channels().
+
+        The channels are taken to follow each other in one frame of pixels, so
+        a target with a start:end slice gets only the part of each channel
+        that falls in its slice, and no message at all for channels outside
+        it.  Each distinct part is encoded only once.
+
+        """
+        # where each channel's pixels start in the whole frame
+        offsets = []
+        offset = 0
+        for channel, pixels in channel_pixels:
+            offsets.append(offset)
+            offset += len(pixels)
+
+        messages = {}
+        success = True
+        for client, start, end in self._targets:
+            channel_messages = []
+            for (channel, pixels), offset in zip(channel_pixels, offsets):
+                lo = max(0, (start or 0) - offset)
+                hi = len(pixels) if end is None else min(len(pixels), end - offset)
+                if lo >= hi:
+                    continue
+                key = (channel, offset + lo, offset + hi)
+                if key not in messages:
+                    messages[key] = client.build_message(pixels[lo:hi], channel)
+                channel_messages.append((channel, messages[key]))
+            success = client.put_channel_messages(channel_messages) and success
+        return success
+
+    def set_color_correction(self, *args, **kwargs):
+        """Set Fadecandy color correction on every target; see Client.set_color_correction()."""
+        success = True
+        for client in self.clients:
+            success = client.set_color_correction(*args, **kwargs) and success
+        return success
+
+    def set_firmware_config(self, *args, **kwargs):
+        """Set Fadecandy firmware options on every target; see Client.set_firmware_config()."""
+        success = True
+        for client in self.clients:
+            success = client.set_firmware_config(*args, **kwargs) and success
+        return success
+
+    def put_payload(self, payload, channel=0):
+        """Queue a buffer of raw r, g, b bytes for every target, slicing it as needed."""
+        view = memoryview(payload)
+        success = True
+        for client, start, end in self._targets:
+            part = view[start * 3 if start is not None else None:end * 3 if end is not None else None]
+            success = client.put_payload(part, channel) and success
+        return success
+
+    def put_message(self, message):
+        """Queue the same encoded OPC message for every target."""
+        success = True
+        for client in self.clients:
+            success = client.put_message(message) and success
+        return success
+
+    def disconnect(self):
+        for client in self.clients:
+            client.disconnect()
+
+    def close(self):
+        """Stop every target's worker thread."""
+        for client in self.clients:
+            client.close()
+
+
+def parse_targets(servers):
+    """Parse a comma separated list of servers for FanoutClient.
+
+    Each server is ip:port, optionally followed by @start:end to send only
+    that slice of the pixels.  For example 'localhost:7890,10.0.0.2:7890@64:128'.
+
+    """
+    targets = []
+    for server in servers.split(','):
+        server = server.strip()
+        if '@' in server:
+            server_ip_port, pixel_range = server.split('@')
+            start, end = pixel_range.split(':')
+            targets.append((server_ip_port, int(start), int(end)))
+        else:
+            targets.append(server)
+    return targets
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+"""A small local Open Pixel Control server for testing and benchmarks.
+
+Receives OPC messages over TCP or UDP, checks that they are well formed and
+records when each one arrived, so opc.Client and friends (or the whole
+Sloshbox pipeline) can be measured without a real fcserver or any LEDs.
+
+Recommended use, from the command line:
+
+    python opc_server.py --port 7890
+    python Sloshbox.py --server localhost:7890
+
+which prints throughput and inter-frame jitter every second (add --udp to
+listen for opc.UDPClient instead).  Or in-process:
+
+    import opc, opc_server
+
+    server = opc_server.UDPServer(port=7891)
+    server.start()
+
+    client = opc.UDPClient('127.0.0.1:7891')
+    for ii in range(1000):
+        client.put_pixels(my_pixels)
+
+    print(server.stats.report(sent=client.sent))
+    server.stop()
+
+"""
+
+from __future__ import division
+import abc
+import collections
+import math
+import optparse
+import socket
+import struct
+import threading
+import time
+
+# OPC commands
+SET_PIXEL_COLORS = 0x00
+SYSTEM_EXCLUSIVE = 0xFF
+
+def parse_header(data, offset=0):
+    """Split the 4 byte OPC header at offset in data into (channel, command,
+    payload length)."""
+    channel, command, length = struct.unpack_from('>BBH', data, offset)
+    return channel, command, length
+
+def check_payload(command, payload):
+    """Raise ValueError if the payload doesn't make sense for the command."""
+    if command == SET_PIXEL_COLORS:
+        if len(payload) % 3:
+            raise ValueError('%d bytes of pixel colors is not a whole number of pixels' % len(payload))
+    elif command == SYSTEM_EXCLUSIVE:
+        if len(payload) < 2:
+            raise ValueError('system exclusive message without a system ID')
+    else:
+        raise ValueError('unknown OPC command %d' % command)
+
+def parse_message(data):
+    """Check a complete OPC message and return (channel, command, payload).
+
+    Raises ValueError if the message is shorter than a header, its payload
+    doesn't match the length in the header or doesn't suit the command.
+
+    """
+    if len(data) < 4:
+        raise ValueError('OPC message is only %d bytes long' % len(data))
+    channel, command, length = parse_header(data)
+    if len(data) - 4 != length:
+        raise ValueError('OPC header says %d bytes but the payload is %d' % (length, len(data) - 4))
+    payload = data[4:]
+    check_payload(command, payload)
+    return channel, command, payload
+
+# one received message
+Frame = collections.namedtuple('Frame', 'arrived_at channel command payload')
+
+class Stats(object):
+    """Counts messages and bytes received and measures how fast they came.
+
+    The arrival time of the last `keep` messages is kept for measuring
+    inter-frame jitter and latency.  Every connection's thread records into
+    the same Stats, so updates and reports hold a lock.
+
+    """
+
+    def __init__(self, keep=10000):
+        self.arrivals = collections.deque(maxlen=keep)
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.frames = 0
+            self.bytes = 0
+            self.errors = 0
+            self.first_at = None
+            self.last_at = None
+            self.arrivals.clear()
+
+    def record(self, length, arrived_at=None):
+        if arrived_at is None:
+            arrived_at = time.time()
+        with self._lock:
+            if self.first_at is None:
+                self.first_at = arrived_at
+            self.last_at = arrived_at
+            self.frames += 1
+            self.bytes += length
+            self.arrivals.append(arrived_at)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def intervals(self):
+        """Return the times between consecutive kept arrivals."""
+        with self._lock:
+            arrivals = list(self.arrivals)
+        return [b - a for a, b in zip(arrivals, arrivals[1:])]
+
+    def jitter(self):
+        """Return (mean, standard deviation, max) of the inter-frame interval."""
+        intervals = self.intervals()
+        if not intervals:
+            return 0.0, 0.0, 0.0
+        mean = sum(intervals) / len(intervals)
+        variance = sum((ii - mean) ** 2 for ii in intervals) / len(intervals)
+        return mean, math.sqrt(variance), max(intervals)
+
+    def latencies(self, sent_at):
+        """Return the latency of each frame, given the times they were sent.
+
+        sent_at: send times in order, one per frame, for a lossless in-order
+            transport such as TCP.  They are matched against the most recent
+            kept arrivals.
+
+        """
+        with self._lock:
+            arrivals = list(self.arrivals)
+        count = min(len(arrivals), len(sent_at))
+        if not count:
+            return []
+        sent_at = list(sent_at)[-count:]
+        return [arrived - sent for sent, arrived in zip(sent_at, arrivals[-count:])]
+
+    def duration(self):
+        with self._lock:
+            if self.first_at is None:
+                return 0.0
+            return self.last_at - self.first_at
+
+    def fps(self):
+        with self._lock:
+            duration = self.duration()
+            if duration <= 0:
+                return 0.0
+            return (self.frames - 1) / duration
+
+    def report(self, sent=None):
+        """Return a one line summary.  If sent is given, also report loss."""
+        with self._lock:
+            line = '%d frames, %d bytes, %d bad in %.2fs: %.1f fps, %.1f kB/s' % (
+                self.frames, self.bytes, self.errors, self.duration(), self.fps(),
+                self.bytes / 1000 / self.duration() if self.duration() > 0 else 0.0)
+            mean, deviation, worst = self.jitter()
+        if mean:
+            line += ', interval %.2fms +/- %.2fms (max %.2fms)' % (1000 * mean, 1000 * deviation, 1000 * worst)
+        if sent:
+            lost = sent - self.frames
+            line += ', %d lost (%.1f%%)' % (lost, 100 * lost / sent)
+        return line
+
+def latency_report(latencies):
+    """Summarize a list of per-frame latencies as a one line string."""
+    if not latencies:
+        return 'no latencies'
+    ordered = sorted(latencies)
+    return 'latency mean %.3fms, median %.3fms, 99%% %.3fms, max %.3fms' % (
+        1000 * sum(ordered) / len(ordered),
+        1000 * ordered[len(ordered) // 2],
+        1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        1000 * ordered[-1])
+
+class Server(abc.ABCMeta('AbstractServer', (object,), {})):
+    """Common parts of the OPC servers; use TCPServer or UDPServer, or
+    subclass it and give it a _run().
+
+    Set on_message to a function taking (channel, command, payload) to see
+    each valid message as it arrives.  If keep_frames is given, the last
+    that many messages are also kept in self.frames as Frame tuples.
+
+    """
+
+    socket_type = None
+    name = 'opc-server'
+
+    def __init__(self, host='127.0.0.1', port=7890, keep_frames=0):
+        self.host = host
+        self.port = port
+        self.stats = Stats()
+        self.frames = collections.deque(maxlen=keep_frames)
+        self.on_message = None
+        self._socket = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, self.socket_type)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        # the port may have been 0 (pick any)
+        self.port = self._socket.getsockname()[1]
+        self._socket.settimeout(0.1)
+        self._listen()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        if self._socket:
+            self._socket.close()
+        self._socket = None
+
+    def _listen(self):
+        pass
+
+    @abc.abstractmethod
+    def _run(self):
+        """Receive messages and _handle() them until stop() is called."""
+
+    def _handle(self, data, arrived_at):
+        try:
+            channel, command, payload = parse_message(data)
+        except ValueError:
+            self.stats.record_error()
+            return
+        self.stats.record(len(data), arrived_at)
+        if self.frames.maxlen:
+            self.frames.append(Frame(arrived_at, channel, command, payload))
+        if self.on_message:
+            self.on_message(channel, command, payload)
+
+class TCPServer(Server):
+    """Receive a stream of OPC messages from any number of TCP clients."""
+
+    socket_type = socket.SOCK_STREAM
+    name = 'opc-tcp-server'
+
+    def _listen(self):
+        self._socket.listen(5)
+
+    def _run(self):
+        while self._running:
+            try:
+                connection, address = self._socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            thread = threading.Thread(target=self._serve, args=(connection,), name=self.name)
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        connection.settimeout(0.1)
+        buffered = bytearray()
+        while self._running:
+            try:
+                data = connection.recv(65536)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            if not data:
+                break
+            arrived_at = time.time()
+            buffered += data
+
+            # hand over every complete message in the buffer, then drop them
+            # all at once rather than re-slicing the buffer after each
+            offset = 0
+            while len(buffered) - offset >= 4:
+                channel, command, length = parse_header(buffered, offset)
+                end = offset + 4 + length
+                if len(buffered) < end:
+                    break
+                self._handle(bytes(buffered[offset:end]), arrived_at)
+                offset = end
+            del buffered[:offset]
+        connection.close()
+
+class UDPServer(Server):
+    """Receive OPC messages, one per datagram."""
+
+    socket_type = socket.SOCK_DGRAM
+    name = 'opc-udp-server'
+
+    def _run(self):
+        while self._running:
+            try:
+                data = self._socket.recv(65535)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            self._handle(data, time.time())
+
+def benchmark_tcp(frames=1000, n_pixels=128, fps=0):
+    """Send frames through opc.Client to a local TCPServer and report
+    throughput, jitter and latency.
+
+    fps: frames per second to pace the client at, or 0 to send flat out.
+
+    """
+    import opc
+
+    server = TCPServer(port=0)
+    server.start()
+    client = opc.Client('127.0.0.1:%d' % server.port)
+    pixels = [(ii % 256, 0, 255 - ii % 256) for ii in range(n_pixels)]
+    sent_at = []
+
+    for ii in range(frames):
+        sent_at.append(time.time())
+        client.put_pixels(pixels)
+        if fps:
+            time.sleep(1 / fps)
+
+    # wait for the last frames to arrive
+    deadline = time.time() + 2
+    while server.stats.frames < frames and time.time() < deadline:
+        time.sleep(0.01)
+    client.disconnect()
+    server.stop()
+    return '%s; %s' % (server.stats.report(sent=frames), latency_report(server.stats.latencies(sent_at)))
+
+def benchmark_udp(frames=1000, n_pixels=128, fps=0):
+    """Send frames through opc.UDPClient to a local UDPServer and report.
+
+    fps: frames per second to pace the client at, or 0 to send flat out.
+
+    """
+    import opc
+
+    server = UDPServer(port=0)
+    server.start()
+    client = opc.UDPClient('127.0.0.1:%d' % server.port)
+    pixels = [(ii % 256, 0, 255 - ii % 256) for ii in range(n_pixels)]
+
+    for ii in range(frames):
+        client.put_pixels(pixels)
+        if fps:
+            time.sleep(1 / fps)
+
+    # give the last datagrams time to arrive
+    time.sleep(0.2)
+    server.stop()
+    return server.stats.report(sent=client.sent + client.dropped)
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', dest='port', default=7890,
+                        action='store', type='int',
+                        help='port to listen on')
+    parser.add_option('-u', '--udp', dest='udp', default=False,
+                        action='store_true',
+                        help='listen for UDP datagrams instead of TCP connections')
+    parser.add_option('-b', '--benchmark', dest='benchmark', default=0,
+                        action='store', type='int',
+                        help='instead of listening, send this many frames through a local server and report')
+    options, args = parser.parse_args()
+
+    if options.benchmark:
+        print('TCP: %s' % benchmark_tcp(options.benchmark))
+        print('UDP: %s' % benchmark_udp(options.benchmark))
+    else:
+        if options.udp:
+            server = UDPServer(host='0.0.0.0', port=options.port)
+        else:
+            server = TCPServer(host='0.0.0.0', port=options.port)
+        server.start()
+        print('    listening for OPC on %s port %d (control-c to exit)' % (
+            'UDP' if options.udp else 'TCP', server.port))
+        try:
+            while True:
+                time.sleep(1)
+                print('    %s' % server.stats.report())
+                server.stats.reset()
+        except KeyboardInterrupt:
+            server.stop()
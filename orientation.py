@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""Helpers for turning accelerometer samples into a steady orientation.
+
+Raw ADXL345 samples are noisy enough that the roll/pitch derived from a single
+reading wanders by more than the wave spawn thresholds while the box is sitting
+still.  The filters here smooth the samples before any decision is made about
+them, at a fixed cost per sample.
+
+Recommended use:
+
+    import orientation
+
+    smoother = orientation.AxesFilter(alpha=0.25)
+
+    while True:
+        window = [accelerometer.getAxes(True) for ii in range(4)]
+        xs, ys, zs = smoother.update_window(window)
+        rolls, pitches, magnitudes = orientation.roll_pitch_magnitude_batch(xs, ys, zs)
+        roll, last_roll = orientation.spawn_decision(rolls, last_roll, threshold, increment)
+
+roll_pitch_magnitude_batch() computes a whole window in one pass (vectorized
+with NumPy when it's installed) and spawn_decision() walks the resulting
+angles to decide whether the window should make a wave.
+
+"""
+
+from __future__ import division
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def roll_pitch_magnitude_batch(xs, ys, zs):
+    """Return (rolls, pitches, magnitudes) for a window of N samples at once,
+    the angles in radians.
+
+    xs, ys, zs: equal length sequences holding each axis of the samples.
+
+    NOTE: pitch and roll are swapped relative to the usual convention because
+    our sensor is mounted... strangely.
+
+    With NumPy available the whole window is computed in a handful of array
+    operations and NumPy arrays are returned; otherwise lists are returned.
+
+    """
+    # http://stackoverflow.com/questions/3755059/3d-accelerometer-calculate-the-orientation
+    scale = 180/math.pi
+    if numpy is not None:
+        x = numpy.asarray(xs, dtype=float)
+        y = numpy.asarray(ys, dtype=float)
+        z = numpy.asarray(zs, dtype=float)
+        yz = y * y + z * z
+        pitches = numpy.arctan2(y, z * scale)
+        rolls = numpy.arctan2(-x, numpy.sqrt(yz) * scale)
+        magnitudes = numpy.sqrt(x * x + yz)
+        return rolls, pitches, magnitudes
+
+    atan2 = math.atan2
+    sqrt = math.sqrt
+    pitches = [atan2(y, z * scale) for y, z in zip(ys, zs)]
+    rolls = [atan2(-x, sqrt(y * y + z * z) * scale) for x, y, z in zip(xs, ys, zs)]
+    magnitudes = [sqrt(x * x + y * y + z * z) for x, y, z in zip(xs, ys, zs)]
+    return rolls, pitches, magnitudes
+
+def spawn_decision(angles, last_angle, threshold, increment):
+    """Decide whether a window of angles should spawn a wave.
+
+    angles: the roll (or pitch) of each sample in the window, oldest first.
+    last_angle: the angle at which the previous wave was spawned.
+    threshold: angles within +/- threshold of flat are treated as rest.
+    increment: how far the angle must move from last_angle to count.
+
+    Returns (angle, last_angle).  angle is the most recent angle in the window
+    that triggered a wave, or None if none did.  last_angle is updated in the
+    same way align() would have updated it sample by sample.
+
+    """
+    if numpy is not None and isinstance(angles, numpy.ndarray):
+        angles = angles.tolist()
+
+    triggered = None
+    for angle in angles:
+        if -threshold <= angle <= threshold:
+            continue
+        if (last_angle - increment) <= angle <= (last_angle + increment):
+            continue
+        last_angle = angle
+        triggered = angle
+    return triggered, last_angle
+
+class LowPassFilter(object):
+    """A single-pole low-pass (exponential moving average) filter.
+
+    alpha: how much of each new sample to take, in the range 0-1.
+        1.0 passes samples through untouched, smaller values smooth harder.
+
+    The first sample primes the filter so it doesn't have to ramp up from 0.
+
+    """
+
+    def __init__(self, alpha=0.25):
+        self.alpha = max(0.0, min(1.0, alpha))
+        self.value = None
+
+    def update(self, sample):
+        """Feed in a new sample and return the filtered value."""
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value += self.alpha * (sample - self.value)
+        return self.value
+
+    def reset(self):
+        """Forget the filter history; the next sample will prime it again."""
+        self.value = None
+
+class AxesFilter(object):
+    """Low-pass filter each axis of an {'x', 'y', 'z'} accelerometer sample.
+
+    Filtering the axes rather than the derived angles keeps atan2 from
+    wrapping around at +/- pi and smooths the magnitude along with them.
+
+    """
+
+    def __init__(self, alpha=0.25):
+        self.x = LowPassFilter(alpha)
+        self.y = LowPassFilter(alpha)
+        self.z = LowPassFilter(alpha)
+
+    def update_window(self, window):
+        """Filter a window of samples in order and return (xs, ys, zs) lists."""
+        xs = [self.x.update(axes['x']) for axes in window]
+        ys = [self.y.update(axes['y']) for axes in window]
+        zs = [self.z.update(axes['z']) for axes in window]
+        return xs, ys, zs
+
+    def reset(self):
+        self.x.reset()
+        self.y.reset()
+        self.z.reset()
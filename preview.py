@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""Preview OPC frames without any LEDs.
+
+Listens for Open Pixel Control frames like fcserver does, and draws them
+either in the terminal, as true-color blocks, or as PNG snapshots written
+every so often.  Pixels are placed the way the sender wired them: by the
+same boards file Sloshbox reads (--boards), or by a layout file, whose
+points are listed in wiring order, so what you see is laid out like the
+real installation.
+
+Recommended use:
+
+    python preview.py --boards layouts/boards8x8x2.json
+    python Sloshbox.py --server localhost:7890 --boards layouts/boards8x8x2.json
+
+or, for Sloshbox --map-layout, place the pixels by the layout instead:
+
+    python preview.py --layout layouts/fadecandy8x8x2.json
+
+or, to keep a PNG snapshot up to date instead of drawing in the terminal:
+
+    python preview.py --layout layouts/fadecandy8x8x2.json --png preview.png
+
+"""
+
+from __future__ import division
+import binascii
+import optparse
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import boards
+import layout
+import opc_server
+
+def layout_cells(coordinates):
+    """Place each layout point in a cell of a 2d grid.
+
+    The two axes along which the points are most spread out become the
+    columns and rows; each distinct coordinate along them is one cell.
+
+    Returns (columns, rows, cells) where cells[ii] is the (column, row) of
+    pixel ii.
+
+    """
+    across, down = layout.widest_axes(coordinates)
+
+    # round so that float noise in the layout doesn't split a column in two
+    columns = sorted(set([round(point[across], 4) for point in coordinates]))
+    rows = sorted(set([round(point[down], 4) for point in coordinates]))
+    column_of = dict((value, ii) for ii, value in enumerate(columns))
+    row_of = dict((value, ii) for ii, value in enumerate(rows))
+
+    cells = [(column_of[round(point[across], 4)], row_of[round(point[down], 4)])
+             for point in coordinates]
+    return len(columns), len(rows), cells
+
+def write_png(filename, width, height, rgb):
+    """Write width x height pixels of packed r, g, b bytes as an 8 bit PNG."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', binascii.crc32(kind + data) & 0xFFFFFFFF))
+
+    stride = width * 3
+    raw = bytearray()
+    for row in range(height):
+        raw.append(0)   # no filter
+        raw += rgb[row * stride:(row + 1) * stride]
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(bytes(raw))))
+        f.write(chunk(b'IEND', b''))
+
+def board_cells(specs):
+    """Place each LED of a list of boards (see boards.py) in a cell of the grid
+    they cover, in the order Sloshbox sends them.
+
+    Returns (columns, rows, cells) like layout_cells().
+
+    """
+    columns, rows = boards.grid_size(specs)
+    cells = [(col, row) for spec in specs for row, col in boards.board_cells(spec)]
+    return columns, rows, cells
+
+class Preview(object):
+    """Draws frames of pixels according to a layout."""
+
+    def __init__(self, coordinates, scale=16):
+        self.columns, self.rows, self.cells = layout_cells(coordinates)
+        self.scale = scale
+
+    @classmethod
+    def from_boards(cls, specs, scale=16):
+        """Make a preview which places pixels by a list of boards instead."""
+        preview = cls.__new__(cls)
+        preview.columns, preview.rows, preview.cells = board_cells(specs)
+        preview.scale = scale
+        return preview
+
+    def canvas(self, pixels):
+        """Return a columns x rows bytearray of r, g, b with the pixels placed.
+
+        pixels: packed r, g, b bytes in layout order.  Cells with no pixel, or
+        pixels missing from the frame, stay black.
+
+        """
+        canvas = bytearray(self.columns * self.rows * 3)
+        count = min(len(self.cells), len(pixels) // 3)
+        for ii in range(count):
+            column, row = self.cells[ii]
+            offset = (row * self.columns + column) * 3
+            canvas[offset:offset + 3] = pixels[ii * 3:ii * 3 + 3]
+        return canvas
+
+    def terminal(self, pixels):
+        """Return the frame as a string of true-color terminal blocks."""
+        canvas = self.canvas(pixels)
+        lines = ['\x1b[H']  # cursor home, so each frame draws over the last
+        for row in range(self.rows):
+            line = []
+            for column in range(self.columns):
+                offset = (row * self.columns + column) * 3
+                line.append('\x1b[48;2;%d;%d;%dm  ' % tuple(canvas[offset:offset + 3]))
+            lines.append(''.join(line) + '\x1b[0m\n')
+        return ''.join(lines)
+
+    def png(self, pixels, filename):
+        """Write the frame to a PNG, each pixel drawn as a scale x scale square."""
+        canvas = self.canvas(pixels)
+        width = self.columns * self.scale
+        scaled = bytearray()
+        for row in range(self.rows):
+            line = bytearray()
+            for column in range(self.columns):
+                offset = (row * self.columns + column) * 3
+                line += canvas[offset:offset + 3] * self.scale
+            scaled += line * self.scale
+        write_png(filename, width, self.rows * self.scale, scaled)
+
+class PreviewSink(object):
+    """An OPC server that keeps the latest frame for a Preview to draw.
+
+    Channel 0 frames cover the whole layout.  Frames on other channels start
+    at the pixel index given for that channel in channel_offsets; without it, a
+    frame on channel n > 0 is taken to start at pixel (n - 1) * its length,
+    which matches Sloshbox sending one equally sized board per channel
+    (--per-board).
+
+    """
+
+    def __init__(self, preview, host='127.0.0.1', port=7890, udp=False, channel_offsets=None):
+        self.preview = preview
+        self.channel_offsets = channel_offsets or {}
+        self.pixels = bytearray(len(preview.cells) * 3)
+        self.frames = 0
+        self._lock = threading.Lock()
+        if udp:
+            self.server = opc_server.UDPServer(host, port)
+        else:
+            self.server = opc_server.TCPServer(host, port)
+        self.server.on_message = self._on_message
+
+    def _on_message(self, channel, command, payload):
+        if command != opc_server.SET_PIXEL_COLORS:
+            return
+        offset = 0
+        if channel in self.channel_offsets:
+            offset = self.channel_offsets[channel] * 3
+        elif channel > 0:
+            offset = (channel - 1) * len(payload)
+        with self._lock:
+            end = min(len(self.pixels), offset + len(payload))
+            if offset < end:
+                self.pixels[offset:end] = payload[:end - offset]
+            self.frames += 1
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def run(self, max_fps=10, png=None, png_period=1.0, output=sys.stdout):
+        """Draw the latest frame at most max_fps times a second, forever.
+
+        With png set, write a snapshot to that file every png_period seconds
+        instead of drawing in the terminal.  Nothing is redrawn while no new
+        frames arrive.
+
+        """
+        drawn = 0
+        last_png = 0
+        while True:
+            time.sleep(1 / max_fps)
+            with self._lock:
+                if self.frames == drawn:
+                    continue
+                drawn = self.frames
+                pixels = bytearray(self.pixels)
+
+            if png:
+                if time.time() - last_png >= png_period:
+                    self.preview.png(pixels, png)
+                    last_png = time.time()
+            else:
+                output.write(self.preview.terminal(pixels))
+                output.flush()
+
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-l', '--layout', dest='layout', default='layouts/fadecandy8x8x2.json',
+                        action='store', type='string',
+                        help='layout file, used unless --boards is given')
+    parser.add_option('-B', '--boards', dest='boards', default=None,
+                        action='store', type='string',
+                        help='JSON file of fadecandy boards, as given to Sloshbox --boards, '
+                             'to place pixels in the order Sloshbox sends them')
+    parser.add_option('-p', '--port', dest='port', default=7890,
+                        action='store', type='int',
+                        help='port to listen on')
+    parser.add_option('-u', '--udp', dest='udp', default=False,
+                        action='store_true',
+                        help='listen for UDP datagrams instead of TCP connections')
+    parser.add_option('-f', '--fps', dest='fps', default=10,
+                        action='store', type='int',
+                        help='most frames per second to draw')
+    parser.add_option('--png', dest='png', default=None,
+                        action='store', type='string',
+                        help='write PNG snapshots to this file instead of drawing in the terminal')
+    parser.add_option('--png-period', dest='png_period', default=1.0,
+                        action='store', type='float',
+                        help='seconds between PNG snapshots')
+    options, args = parser.parse_args()
+
+    if options.boards:
+        specs = boards.load_boards(options.boards)
+        # where each board's channel starts, for Sloshbox --per-board
+        channel_offsets = {}
+        offset = 0
+        for ii, spec in enumerate(specs):
+            channel = spec['channel'] if spec['channel'] is not None else ii + 1
+            channel_offsets[channel] = offset
+            offset += spec['width'] * spec['height']
+        sink = PreviewSink(Preview.from_boards(specs), '0.0.0.0', options.port, options.udp,
+                           channel_offsets)
+    else:
+        sink = PreviewSink(Preview(layout.load_layout(options.layout)), '0.0.0.0', options.port, options.udp)
+    sink.start()
+    if not options.png:
+        sys.stdout.write('\x1b[2J')  # clear the screen once
+    try:
+        sink.run(options.fps, options.png, options.png_period)
+    except KeyboardInterrupt:
+        sink.stop()